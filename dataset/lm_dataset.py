@@ -1,30 +1,301 @@
 import json
+import numpy as np
 from PIL import Image
 from torch.utils.data import Dataset, DataLoader
 import torch
+from torch.nn.utils.rnn import pad_sequence
 from model.model_vlm import MiniMindVLM
 import os
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
 
+def load_image_tensors(images_path, image_paths, preprocess):
+    images = [Image.open(f'{images_path}/{image_name.strip()}') for image_name in image_paths.split(',')]
+    return MiniMindVLM.images2tensor(images, preprocess).unsqueeze(1)
+
+
+def _next_match_index(input_ids, pattern):
+    # out[b, i] = 最小的 j >= i 使 input_ids[b, j:j+len(pattern)] == pattern，找不到为 L；多一列 out[:, L] = L
+    bsz, seq_len = input_ids.shape
+    positions = torch.full((bsz, seq_len + 1), seq_len, dtype=torch.long, device=input_ids.device)
+    n = len(pattern)
+    if 0 < n <= seq_len:
+        pattern = torch.tensor(pattern, dtype=input_ids.dtype, device=input_ids.device)
+        matches = (input_ids.unfold(1, n, 1) == pattern).all(dim=-1)
+        idx = torch.arange(matches.size(1), device=input_ids.device).expand_as(matches)
+        positions[:, :matches.size(1)] = torch.where(matches, idx, torch.full_like(idx, seq_len))
+    return torch.flip(torch.cummin(torch.flip(positions, [1]), dim=1).values, [1])
+
+
+def generate_loss_mask_batch(input_ids, bos_id, eos_id, max_length):
+    """VLMDataset._generate_loss_mask 的批量向量化版本，结果逐位一致。
+
+    从左到右贪心匹配：找到 bos_id 后取其后第一个 eos_id，标记 (start, end+len(eos_id)] 区间
+    （上限 max_length），再从该 eos_id 之后继续找下一个 bos_id。循环次数只等于 assistant 轮数。
+    """
+    bsz, seq_len = input_ids.shape
+    device = input_ids.device
+    next_bos = _next_match_index(input_ids, bos_id)
+    next_eos = _next_match_index(input_ids, eos_id)
+    cap = min(seq_len, max_length)
+
+    delta = torch.zeros(bsz, seq_len + 2, dtype=torch.long, device=device)
+    cursor = torch.zeros(bsz, dtype=torch.long, device=device)
+    rows = torch.arange(bsz, device=device)
+    while True:
+        bos_pos = next_bos[rows, cursor]
+        active = bos_pos < seq_len
+        if not active.any():
+            break
+        start = (bos_pos + len(bos_id)).clamp(max=seq_len)
+        end = next_eos[rows, start]
+        lo = (start + 1).clamp(max=seq_len + 1)
+        hi = (end + len(eos_id) + 1).clamp(max=cap)
+        valid = (active & (lo < hi)).long()
+        delta.scatter_add_(1, lo.unsqueeze(1), valid.unsqueeze(1))
+        delta.scatter_add_(1, hi.clamp(min=0).unsqueeze(1), -valid.unsqueeze(1))
+        cursor = torch.where(active & (end < seq_len), (end + len(eos_id)).clamp(max=seq_len),
+                             torch.full_like(cursor, seq_len))
+    return (delta.cumsum(dim=1)[:, :seq_len] > 0).long()
+
+
+def _pad_images(images):
+    # 每个样本的图像数可以不同：沿图像维补零到 batch 内最大值，另返回 image_mask [bs, num] 标记有效槽位
+    num = max(len(x) for x in images)
+    pixel_values = images[0].new_zeros((len(images), num, *images[0].shape[1:]))
+    image_mask = torch.zeros(len(images), num, dtype=torch.bool)
+    for i, x in enumerate(images):
+        pixel_values[i, :len(x)] = x
+        image_mask[i, :len(x)] = True
+    return pixel_values, image_mask
+
+
+def vlm_collate_fn(batch, pad_token_id=0):
+    # padding=False 的变长样本补齐到 batch 内最长（配合 LengthBucketBatchSampler），定长样本等价于 stack
+    X, Y, loss_mask, images, image_pos = zip(*batch)
+    pixel_values, image_mask = _pad_images(images)
+    return (pad_sequence(X, batch_first=True, padding_value=pad_token_id),
+            pad_sequence(Y, batch_first=True, padding_value=pad_token_id),
+            pad_sequence(loss_mask, batch_first=True), pixel_values, image_mask,
+            pad_sequence(image_pos, batch_first=True))
+
+
+def vlm_pack_collate_fn(batch, max_length, pad_token_id, image_token_len):
+    """把 padding=False 的样本按 first-fit 首尾拼接成若干行（每行不超过 max_length - 1 个 token），行尾补 pad 到最长行。
+
+    X / Y / loss_mask 按样本各自移位后再拼接，loss 不会跨样本；额外返回 position_ids，在每个样本开头归零，
+    模型据此重置 RoPE 位置并构建文档内因果掩码。行尾 pad 自成一段。
+    """
+    rows, lengths = [], []
+    for i, sample in enumerate(batch):
+        n = len(sample[0])
+        r = next((r for r, used in enumerate(lengths) if used + n <= max_length - 1), len(rows))
+        if r == len(rows):
+            rows.append([])
+            lengths.append(0)
+        rows[r].append(i)
+        lengths[r] += n
+
+    seq_len = max(lengths)
+    X = torch.full((len(rows), seq_len), pad_token_id, dtype=torch.long)
+    Y = torch.full((len(rows), seq_len), pad_token_id, dtype=torch.long)
+    loss_mask = torch.zeros((len(rows), seq_len), dtype=torch.long)
+    image_pos = torch.zeros((len(rows), seq_len), dtype=torch.bool)
+    position_ids = torch.zeros((len(rows), seq_len), dtype=torch.long)
+    images = []
+    for r, idxs in enumerate(rows):
+        pos, row_images = 0, []
+        for i in idxs:
+            x, y, mask, image_tensors, pos_i = batch[i]
+            n = len(x)
+            # 第 k 段完整 image token 对应该样本第 k 张图：多出的段或图都丢弃，避免后一个样本的图错位到前一个样本
+            pos_i = pos_i & ((pos_i.cumsum(0) - 1) // image_token_len < len(image_tensors))
+            row_images.append(image_tensors[:int(pos_i.sum()) // image_token_len])
+            X[r, pos:pos + n] = x
+            Y[r, pos:pos + n] = y
+            loss_mask[r, pos:pos + n] = mask
+            image_pos[r, pos:pos + n] = pos_i
+            position_ids[r, pos:pos + n] = torch.arange(n)
+            pos += n
+        position_ids[r, pos:] = torch.arange(seq_len - pos)
+        images.append(torch.cat(row_images))
+    pixel_values, image_mask = _pad_images(images)
+    return X, Y, loss_mask, pixel_values, image_mask, image_pos, position_ids
+
+
+class VisionFeatureStore:
+    """冻结 CLIP 的 patch 特征库（scripts/extract_vision_features.py 生成），按图片路径取 [T, D] float16。
+
+    {prefix}.features.bin  float16 memmap [N, T, D]
+    {prefix}.index.json    {"shape": [N, T, D], "images": {image_name: row}}
+    """
+
+    def __init__(self, prefix):
+        with open(f'{prefix}.index.json', 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        self.prefix = prefix
+        self.shape = tuple(meta['shape'])
+        self.rows = meta['images']
+        self._features = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_features'] = None
+        return state
+
+    def __contains__(self, image_name):
+        return image_name in self.rows
+
+    def __getitem__(self, image_name):
+        if self._features is None:
+            self._features = np.memmap(f'{self.prefix}.features.bin', dtype=np.float16, mode='r', shape=self.shape)
+        return self._features[self.rows[image_name]]
+
+    def load(self, image_paths):
+        # 与 load_image_tensors 相同的 ',' 分隔多图约定，返回 [num, T, D]
+        return torch.stack([torch.from_numpy(np.array(self[name.strip()])) for name in image_paths.split(',')], dim=0)
+
+
+class ImageShardStore:
+    """预先 resize + center crop 的 uint8 图像分片（scripts/pack_image_shards.py 生成），mmap 读取后按 CLIP 均值方差归一化。
+
+    {prefix}-NNNNN.bin  uint8 [n, S, S, 3]
+    {prefix}.index.json {"size": S, "image_mean": [...], "image_std": [...], "shards": [n, ...],
+                         "images": {image_name: [shard, row]}}
+    """
+
+    def __init__(self, prefix):
+        with open(f'{prefix}.index.json', 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        self.prefix = prefix
+        self.size = meta['size']
+        self.shard_sizes = meta['shards']
+        self.rows = meta['images']
+        self.mean = torch.tensor(meta['image_mean'], dtype=torch.float32).view(3, 1, 1)
+        self.std = torch.tensor(meta['image_std'], dtype=torch.float32).view(3, 1, 1)
+        self._shards = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = None
+        return state
+
+    def __contains__(self, image_name):
+        return image_name in self.rows
+
+    def __getitem__(self, image_name):
+        if self._shards is None:
+            self._shards = [np.memmap(f'{self.prefix}-{i:05d}.bin', dtype=np.uint8, mode='r', shape=(n, self.size, self.size, 3))
+                            for i, n in enumerate(self.shard_sizes)]
+        shard, row = self.rows[image_name]
+        return self._shards[shard][row]
+
+    def load(self, image_paths):
+        # 与 load_image_tensors 返回形状一致：[num, 1, 3, S, S]
+        pixels = torch.from_numpy(np.stack([self[name.strip()] for name in image_paths.split(',')]))
+        pixels = pixels.permute(0, 3, 1, 2).float().mul_(1 / 255)
+        return ((pixels - self.mean) / self.std).unsqueeze(1)
+
+
 class VLMDataset(Dataset):
     def __init__(self, jsonl_path, images_path, tokenizer, preprocess=None, max_length=512,
-                 image_special_token='@' * 196):
+                 image_special_token='@' * 196, lazy_load=False, vision_features=None, image_shards=None,
+                 padding=True):
 
         super().__init__()
-        self.samples = self.load_data(jsonl_path)
+        # padding=False 时不补齐到 max_length，返回变长样本（由 vlm_pack_collate_fn 拼接）
+        self.padding = padding
+        # 传入特征库前缀时，第 4 个返回值是预提取的 CLIP 特征而不是 pixel_values
+        self.feature_store = VisionFeatureStore(vision_features) if vision_features else None
+        self.image_store = ImageShardStore(image_shards) if image_shards else None
+        self.jsonl_path = jsonl_path
+        self.lazy_load = lazy_load
+        if lazy_load:
+            # 只保留每行的字节偏移（numpy 数组，无 Python 对象），__getitem__ 时再读取并解析该行
+            self.samples = None
+            self.line_offsets = self.load_line_offsets(jsonl_path)
+            self._file = None
+            self._file_pid = None
+        else:
+            self.samples = self.load_data(jsonl_path)
         self.images_path = images_path
 
         self.tokenizer = tokenizer
         self.max_length = max_length
         self.preprocess = preprocess
         self.image_token = image_special_token
+        self.image_ids = tokenizer(image_special_token, add_special_tokens=False).input_ids
         self.bos_id = tokenizer('<|im_start|>assistant', add_special_tokens=False).input_ids
         self.eos_id = tokenizer('<|im_end|>', add_special_tokens=False).input_ids
 
     def __len__(self):
-        return len(self.samples)
+        return len(self.line_offsets) if self.lazy_load else len(self.samples)
+
+    @staticmethod
+    def load_line_offsets(path):
+        # 索引缓存在 {path}.idx.npy，jsonl 比索引新时重建
+        idx_path = f'{path}.idx.npy'
+        if os.path.exists(idx_path) and os.path.getmtime(idx_path) >= os.path.getmtime(path):
+            return np.load(idx_path)
+        offsets = []
+        pos = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    offsets.append(pos)
+                pos += len(line)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        try:
+            # DDP 下各 rank 同时写，先写临时文件再替换
+            tmp_path = f'{idx_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.save(f, offsets)
+            os.replace(tmp_path, idx_path)
+        except OSError:
+            pass
+        return offsets
+
+    def sample_lengths(self, chunk_size=1000):
+        """每个样本不补齐时的 token 数（截断到 max_length），供 LengthBucketBatchSampler 分桶。
+
+        未截断的长度缓存在 {jsonl}.len{图像token数}.npy，jsonl 比缓存新时重建。
+        """
+        len_path = f'{self.jsonl_path}.len{len(self.image_ids)}.npy'
+        if os.path.exists(len_path) and os.path.getmtime(len_path) >= os.path.getmtime(self.jsonl_path):
+            lengths = np.load(len_path)
+        else:
+            lengths = []
+            for start in range(0, len(self), chunk_size):
+                prompts = [self._create_chat_prompt(self.get_sample(i)['conversations'])
+                           for i in range(start, min(start + chunk_size, len(self)))]
+                lengths.extend(len(ids) for ids in self.tokenizer(prompts).input_ids)
+            lengths = np.asarray(lengths, dtype=np.int32)
+            try:
+                # DDP 下各 rank 同时写，先写临时文件再替换
+                tmp_path = f'{len_path}.{os.getpid()}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, lengths)
+                os.replace(tmp_path, len_path)
+            except OSError:
+                pass
+        return np.minimum(lengths, self.max_length)
+
+    def get_sample(self, index):
+        if not self.lazy_load:
+            return self.samples[index]
+        # 每个 worker 进程各自打开文件，避免 fork 后共享文件偏移
+        if self._file is None or self._file_pid != os.getpid():
+            self._file = open(self.jsonl_path, 'rb')
+            self._file_pid = os.getpid()
+        self._file.seek(int(self.line_offsets[index]))
+        return json.loads(self._file.readline())
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.lazy_load:
+            state['_file'] = None
+        return state
 
     def load_data(self, path):
         samples = []
@@ -46,41 +317,142 @@ class VLMDataset(Dataset):
         )
 
     def _generate_loss_mask(self, input_ids):
-        loss_mask = [0] * len(input_ids)
-        i = 0
-        while i < len(input_ids):
-            if input_ids[i:i + len(self.bos_id)] == self.bos_id:
-                start = i + len(self.bos_id)
-                end = start
-                while end < len(input_ids):
-                    if input_ids[end:end + len(self.eos_id)] == self.eos_id:
-                        break
-                    end += 1
-                for j in range(start + 1, min(end + len(self.eos_id) + 1, self.max_length)):
-                    loss_mask[j] = 1
-                i = end + len(self.eos_id) if end < len(input_ids) else len(input_ids)
-            else:
-                i += 1
-        return loss_mask
+        return self.generate_loss_masks(torch.tensor([input_ids], dtype=torch.long))[0].tolist()
+
+    def generate_loss_masks(self, input_ids):
+        """[B, L] LongTensor -> [B, L] loss_mask，可直接在 collate_fn 中对整个 batch 调用。"""
+        return generate_loss_mask_batch(input_ids, self.bos_id, self.eos_id, self.max_length)
 
     def __getitem__(self, index: int):
-        sample = self.samples[index]
+        sample = self.get_sample(index)
         image_paths = sample['image']
         prompt = self._create_chat_prompt(sample['conversations'])
         input_ids = self.tokenizer(prompt).input_ids[:self.max_length]
-        input_ids += [self.tokenizer.pad_token_id] * (self.max_length - len(input_ids))
-        loss_mask = self._generate_loss_mask(input_ids)
-
-        X = torch.tensor(input_ids[:-1], dtype=torch.long)
-        Y = torch.tensor(input_ids[1:], dtype=torch.long)
-        loss_mask = torch.tensor(loss_mask[1:], dtype=torch.long)
-
-        image_tensors = []
-        for image_name in image_paths.split(','):
-            image_name = image_name.strip()
-            image = Image.open(f'{self.images_path}/{image_name}')
-            image_tensor = MiniMindVLM.image2tensor(image, self.preprocess)
-            image_tensors.append(image_tensor)
-        image_tensors = torch.stack(image_tensors, dim=0)
-
-        return X, Y, loss_mask, image_tensors
+        n_tokens = len(input_ids)
+        input_ids += [self.tokenizer.pad_token_id] * (self.max_length - n_tokens)
+        input_ids = torch.tensor(input_ids, dtype=torch.long)
+        loss_mask = self.generate_loss_masks(input_ids.unsqueeze(0))[0]
+        if not self.padding:
+            # 与 pack_vlm_dataset 相同：保留到 max(有效 token 数, 最后一个 loss_mask=1 的位置+1)
+            n = max(n_tokens, int(loss_mask.nonzero().max()) + 1 if loss_mask.any() else 0)
+            input_ids, loss_mask = input_ids[:n], loss_mask[:n]
+
+        X = input_ids[:-1]
+        Y = input_ids[1:]
+        loss_mask = loss_mask[1:]
+        image_pos = MiniMindVLM.image_token_mask(X.unsqueeze(0), self.image_ids)[0]
+
+        if self.feature_store is not None:
+            image_tensors = self.feature_store.load(image_paths)
+        elif self.image_store is not None:
+            image_tensors = self.image_store.load(image_paths)
+        else:
+            image_tensors = load_image_tensors(self.images_path, image_paths, self.preprocess)
+
+        return X, Y, loss_mask, image_tensors, image_pos
+
+
+# 预分词打包格式（{prefix}.*）：
+#   tokens.bin   uint16 token ids，所有样本首尾相接
+#   mask.bin     loss_mask 位图（np.packbits），与 tokens 共用 offsets
+#   offsets.npy  int64 [N+1]，样本 i 占 [offsets[i], offsets[i+1])
+#   meta.json    max_length / pad_token_id / image_special_token / image_ids / 每个样本的 image 引用
+# 每个样本存到 max(有效 token 数, 最后一个 loss_mask=1 的位置+1)，其余部分读取时补 pad / 0
+def pack_vlm_dataset(jsonl_path, out_prefix, tokenizer, max_length=512, image_special_token='@' * 196):
+    assert len(tokenizer) <= np.iinfo(np.uint16).max + 1, "vocab 超出 uint16 范围"
+    ds = VLMDataset(jsonl_path, None, tokenizer, max_length=max_length,
+                    image_special_token=image_special_token)
+    offsets = [0]
+    masks = []
+    images = []
+    with open(f'{out_prefix}.tokens.bin', 'wb') as f_tokens:
+        for sample in ds.samples:
+            prompt = ds._create_chat_prompt(sample['conversations'])
+            input_ids = tokenizer(prompt).input_ids[:max_length]
+            n_tokens = len(input_ids)
+            input_ids += [tokenizer.pad_token_id] * (max_length - n_tokens)
+            loss_mask = ds._generate_loss_mask(input_ids)
+            n = max(n_tokens, max((j + 1 for j, m in enumerate(loss_mask) if m), default=0))
+            f_tokens.write(np.asarray(input_ids[:n], dtype=np.uint16).tobytes())
+            masks.append(np.asarray(loss_mask[:n], dtype=np.uint8))
+            offsets.append(offsets[-1] + n)
+            images.append(sample['image'])
+
+    mask_bits = np.packbits(np.concatenate(masks) if masks else np.zeros(0, dtype=np.uint8))
+    mask_bits.tofile(f'{out_prefix}.mask.bin')
+    np.save(f'{out_prefix}.offsets.npy', np.asarray(offsets, dtype=np.int64))
+    with open(f'{out_prefix}.meta.json', 'w', encoding='utf-8') as f:
+        json.dump({
+            'source': os.path.abspath(jsonl_path),
+            'max_length': max_length,
+            'pad_token_id': tokenizer.pad_token_id,
+            'image_special_token': image_special_token,
+            'image_ids': ds.image_ids,
+            'num_samples': len(images),
+            'num_tokens': offsets[-1],
+            'images': images,
+        }, f, ensure_ascii=False)
+    return len(images), offsets[-1]
+
+
+class PackedVLMDataset(Dataset):
+    """直接从 pack_vlm_dataset 的 memmap 数组取样本，__getitem__ 只做切片，不再调用 tokenizer。"""
+
+    def __init__(self, packed_prefix, images_path, preprocess=None, vision_features=None, image_shards=None,
+                 padding=True):
+        super().__init__()
+        self.padding = padding
+        self.feature_store = VisionFeatureStore(vision_features) if vision_features else None
+        self.image_store = ImageShardStore(image_shards) if image_shards else None
+        with open(f'{packed_prefix}.meta.json', 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        self.packed_prefix = packed_prefix
+        self.images_path = images_path
+        self.preprocess = preprocess
+        self.max_length = meta['max_length']
+        self.pad_token_id = meta['pad_token_id']
+        self.image_token = meta['image_special_token']
+        self.image_ids = meta['image_ids']
+        self.images = meta['images']
+        self.offsets = np.load(f'{packed_prefix}.offsets.npy')
+        # memmap 在各 DataLoader worker 内首次访问时再打开，避免随 Dataset 一起被 pickle
+        self._tokens = None
+        self._mask_bits = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def sample_lengths(self):
+        # 打包时已按有效长度存储，直接由 offsets 得到
+        return np.minimum(np.diff(self.offsets), self.max_length)
+
+    def _open(self):
+        if self._tokens is None:
+            self._tokens = np.memmap(f'{self.packed_prefix}.tokens.bin', dtype=np.uint16, mode='r')
+            self._mask_bits = np.memmap(f'{self.packed_prefix}.mask.bin', dtype=np.uint8, mode='r')
+
+    def __getitem__(self, index: int):
+        self._open()
+        start, end = int(self.offsets[index]), int(self.offsets[index + 1])
+        n = end - start
+
+        length = self.max_length if self.padding else n
+        input_ids = np.full(length, self.pad_token_id, dtype=np.int64)
+        input_ids[:n] = self._tokens[start:end]
+        loss_mask = np.zeros(length, dtype=np.int64)
+        bits = np.unpackbits(self._mask_bits[start // 8:(end + 7) // 8])
+        loss_mask[:n] = bits[start % 8:start % 8 + n]
+
+        X = torch.from_numpy(input_ids[:-1])
+        Y = torch.from_numpy(input_ids[1:])
+        loss_mask = torch.from_numpy(loss_mask[1:])
+        image_pos = MiniMindVLM.image_token_mask(X.unsqueeze(0), self.image_ids)[0]
+
+        if self.feature_store is not None:
+            image_tensors = self.feature_store.load(self.images[index])
+        elif self.image_store is not None:
+            image_tensors = self.image_store.load(self.images[index])
+        else:
+            image_tensors = load_image_tensors(self.images_path, self.images[index], self.preprocess)
+
+        return X, Y, loss_mask, image_tensors, image_pos
@@ -4,7 +4,7 @@ import warnings
 import torch
 from PIL import Image
 from transformers import AutoTokenizer, AutoModelForCausalLM, TextStreamer
-from model.model_vlm import MiniMindVLM, VLMConfig
+from model.model_vlm import MiniMindVLM, VLMConfig, VisionEmbedCache
 from trainer.trainer_utils import setup_seed
 warnings.filterwarnings('ignore')
 
@@ -14,14 +14,17 @@ def init_model(args):
         moe_suffix = '_moe' if args.use_moe else ''
         ckp = f'./{args.save_dir}/{args.weight}_{args.hidden_size}{moe_suffix}.pth'
         model = MiniMindVLM(
-            VLMConfig(hidden_size=args.hidden_size, num_hidden_layers=args.num_hidden_layers, use_moe=bool(args.use_moe)),
-            vision_model_path="./model/vision_model/clip-vit-base-patch16"
+            VLMConfig(hidden_size=args.hidden_size, num_hidden_layers=args.num_hidden_layers, use_moe=bool(args.use_moe),
+                      image_token_len=args.image_tokens, vision_compress=args.vision_compress),
+            vision_model_path="./model/vision_model/clip-vit-base-patch16",
+            vision_int8=bool(args.vision_int8)
         )
         state_dict = torch.load(ckp, map_location=args.device)
         model.load_state_dict({k: v for k, v in state_dict.items() if 'mask' not in k}, strict=False)
     else:
         model = AutoModelForCausalLM.from_pretrained(args.load_from, trust_remote_code=True)
-        model.vision_encoder, model.processor = MiniMindVLM.get_vision_model("./model/vision_model/clip-vit-base-patch16")
+        model.vision_encoder, model.processor = MiniMindVLM.get_vision_model("./model/vision_model/clip-vit-base-patch16",
+                                                                             int8=bool(args.vision_int8))
     
     print(f'VLM模型参数: {sum(p.numel() for p in model.parameters() if p.requires_grad) / 1e6:.2f} M(illion)')
     preprocess = model.processor
@@ -36,14 +39,24 @@ def main():
     parser.add_argument('--hidden_size', default=512, type=int, help="隐藏层维度（512=Small-26M, 768=Base-104M）")
     parser.add_argument('--num_hidden_layers', default=8, type=int, help="隐藏层数量（Small=8, Base=16）")
     parser.add_argument('--use_moe', default=0, type=int, choices=[0, 1], help="是否使用MoE架构（0=否，1=是）")
+    parser.add_argument('--image_tokens', default=196, type=int, help="每张图的视觉token数（196=不压缩，49/16等需与训练时一致）")
+    parser.add_argument('--vision_compress', default='pool', type=str, choices=['pool', 'resampler'], help="视觉token压缩方式（image_tokens<196时生效）")
     parser.add_argument('--max_new_tokens', default=512, type=int, help="最大生成长度")
     parser.add_argument('--temperature', default=0.65, type=float, help="生成温度，控制随机性（0-1，越大越随机）")
     parser.add_argument('--top_p', default=0.85, type=float, help="nucleus采样阈值（0-1）")
     parser.add_argument('--image_dir', default='./dataset/eval_images/', type=str, help="测试图像目录")
     parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str, help="运行设备")
+    parser.add_argument('--vision_int8', default=0, type=int, choices=[0, 1], help="vision encoder 是否使用动态int8量化（0=否，1=是，仅CPU）")
+    parser.add_argument('--vision_cache', default='', type=str, help="图像特征缓存文件（非空时启动加载、结束保存，可与web_demo共用）")
+    parser.add_argument('--vision_cache_mb', default=256, type=int, help="图像特征缓存上限（MB，LRU淘汰）")
+    parser.add_argument('--draft_decode', default=0, type=int, choices=[0, 1], help="大JPEG是否按目标尺寸降采样解码（0=否，与训练一致，1=是，更快但像素有偏差）")
     args = parser.parse_args()
     
     model, tokenizer, preprocess = init_model(args)
+    # 旧版 remote code 导出的 transformers 模型没有 embed_images，回退到 pixel_values 路径（不使用特征缓存）
+    vision_cache = VisionEmbedCache(max_bytes=args.vision_cache_mb * 1024 ** 2, tag=model.vision_cache_tag() + ('-draft' if args.draft_decode else '')) \
+        if hasattr(model, 'embed_images') else None
+    if args.vision_cache and vision_cache is not None: vision_cache.load(args.vision_cache, device=args.device)
     streamer = TextStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
     # 自动测试image_dir中的所有图像
     prompt = "仔细看一下这张图：\n\n<image>\n\n描述一下这个图像的内容。"
@@ -51,8 +64,12 @@ def main():
         if image_file.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp')):
             setup_seed(2026) # or setup_seed(random.randint(1, 10000))
             image_path = os.path.join(args.image_dir, image_file)
-            image = Image.open(image_path).convert('RGB')
-            pixel_values = MiniMindVLM.image2tensor(image, preprocess).to(args.device).unsqueeze(0)
+            if vision_cache is not None:
+                image_inputs = {'vision_embeds': model.embed_images([image_path], cache=vision_cache, draft=bool(args.draft_decode))}
+            else:
+                image = Image.open(image_path)
+                image_inputs = {'pixel_values': MiniMindVLM.images2tensor([image], preprocess, draft=bool(args.draft_decode))
+                                .to(args.device).unsqueeze(0)}
             
             messages = [{"role": "user", "content": prompt.replace('<image>', model.params.image_special_token)}]
             inputs_text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
@@ -65,9 +82,12 @@ def main():
                 inputs=inputs["input_ids"], attention_mask=inputs["attention_mask"],
                 max_new_tokens=args.max_new_tokens, do_sample=True, streamer=streamer,
                 pad_token_id=tokenizer.pad_token_id, eos_token_id=tokenizer.eos_token_id,
-                top_p=args.top_p, temperature=args.temperature, pixel_values=pixel_values
+                top_p=args.top_p, temperature=args.temperature, **image_inputs
             )
             print('\n\n')
+    if vision_cache is not None:
+        print(f'图像特征缓存: {vision_cache.stats()}')
+        if args.vision_cache: vision_cache.save(args.vision_cache)
 
 if __name__ == "__main__":
     main()
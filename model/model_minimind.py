@@ -25,6 +25,7 @@ class MiniMindConfig(PretrainedConfig):
             rope_theta: int = 1000000.0,
             inference_rope_scaling: bool = False,
             flash_attn: bool = True,
+            static_kv_cache: bool = True,
             ####################################################
             # Here are the specific configurations of MOE
             # When use_moe is false, the following is invalid
@@ -63,6 +64,7 @@ class MiniMindConfig(PretrainedConfig):
             "type": "yarn"
         } if self.inference_rope_scaling else None
         self.flash_attn = flash_attn
+        self.static_kv_cache = static_kv_cache  # generate() 时使用预分配的 StaticKVCache
         ####################################################
         # Here are the specific configurations of MOE
         # When use_moe is false, the following is invalid
@@ -86,9 +88,11 @@ import torch
 import torch.nn.init as init
 import torch.nn.functional as F
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 from transformers.activations import ACT2FN
 from typing import Optional, Tuple, List, Union
 from transformers import PreTrainedModel, GenerationMixin, PretrainedConfig
+from transformers.generation import GenerationMode
 from transformers.modeling_outputs import CausalLMOutputWithPast
 
 
@@ -106,7 +110,8 @@ class RMSNorm(torch.nn.Module):
 
 
 def precompute_freqs_cis(dim: int, end: int = int(32 * 1024), rope_base: float = 1e6,
-                         rope_scaling: Optional[dict] = None):
+                         rope_scaling: Optional[dict] = None, length: Optional[int] = None):
+    # length 不为空时只计算前 length 个位置（是否做 YaRN 缩放仍按 end 判断，取值与完整表的前 length 行一致）
     freqs = 1.0 / (rope_base ** (torch.arange(0, dim, 2)[: (dim // 2)].float() / dim))
     if rope_scaling is not None:
         orig_max, factor, beta_fast, beta_slow = (
@@ -121,13 +126,30 @@ def precompute_freqs_cis(dim: int, end: int = int(32 * 1024), rope_base: float =
             scale = torch.where(torch.arange(dim // 2, device=freqs.device) < corr_dim, (beta * factor - beta + 1) / (beta * factor), 1.0 / factor)
             freqs = freqs * scale
 
-    t = torch.arange(end, device=freqs.device)
+    t = torch.arange(end if length is None else length, device=freqs.device)
     freqs = torch.outer(t, freqs).float()
     freqs_cos = torch.cat([torch.cos(freqs), torch.cos(freqs)], dim=-1)
     freqs_sin = torch.cat([torch.sin(freqs), torch.sin(freqs)], dim=-1)
     return freqs_cos, freqs_sin
 
 
+_ROPE_TABLES = {}
+
+
+def get_rope_tables(dim: int, end: int, rope_base: float, rope_scaling: Optional[dict], length: int):
+    """
+    按 (head_dim, rope_base, rope_scaling, end) 在模块级缓存 RoPE 表，所有模型实例共享同一份 CPU 张量。
+    只计算到实际用到的长度，不够时按 2 倍（最多 end）扩展，不再为每个实例预计算 max_position_embeddings 行。
+    """
+    key = (dim, end, float(rope_base), tuple(sorted(rope_scaling.items())) if rope_scaling else None)
+    tables = _ROPE_TABLES.get(key)
+    if tables is None or tables[0].shape[0] < length:
+        size = max(length, min(end, 2 * tables[0].shape[0])) if tables is not None else length
+        tables = _ROPE_TABLES[key] = precompute_freqs_cis(dim=dim, end=end, rope_base=rope_base,
+                                                         rope_scaling=rope_scaling, length=size)
+    return tables
+
+
 def apply_rotary_pos_emb(q, k, cos, sin, position_ids=None, unsqueeze_dim=1):
     def rotate_half(x):
         return torch.cat((-x[..., x.shape[-1] // 2:], x[..., : x.shape[-1] // 2]), dim=-1)
@@ -147,6 +169,79 @@ def repeat_kv(x: torch.Tensor, n_rep: int) -> torch.Tensor:
     )
 
 
+def _lm_head_ce(h, weight, labels):
+    return F.cross_entropy(F.linear(h, weight), labels, reduction='sum')
+
+
+def masked_lm_loss(hidden_states, weight, labels, loss_mask, chunk_size: int = 1024):
+    """
+    只取 loss_mask 位置的 hidden state，分块过 lm_head 求交叉熵，不物化 [bsz, seq_len, vocab] 的完整 logits。
+    每块经 checkpoint 在反向时重算 logits，显存峰值只有一块 [chunk_size, vocab]。
+    结果等于完整 logits 上 CrossEntropyLoss(reduction='none') * loss_mask 的 sum / loss_mask.sum()。
+    """
+    mask = loss_mask.reshape(-1).bool()
+    h = hidden_states.reshape(-1, hidden_states.size(-1))[mask]
+    labels = labels.reshape(-1)[mask]
+    loss = hidden_states.new_zeros((), dtype=torch.float32)
+    for i in range(0, h.size(0), chunk_size):
+        loss = loss + checkpoint(_lm_head_ce, h[i:i + chunk_size], weight, labels[i:i + chunk_size], use_reentrant=False)
+    return loss / loss_mask.sum()
+
+
+class StaticKVLayer:
+    def __init__(self, cache, layer_idx: int):
+        self.cache = cache
+        self.layer_idx = layer_idx
+
+    def update(self, xk: torch.Tensor, xv: torch.Tensor):
+        # 在 [seq_len, seq_len + L) 原地写入，返回 [:seq_len + L] 的视图（不拷贝历史 KV）
+        cache = self.cache
+        start, end = cache.seq_len, cache.seq_len + xk.shape[1]
+        assert end <= cache.max_len, f'StaticKVCache 长度不足: {end} > {cache.max_len}'
+        if cache.keys[self.layer_idx] is None:
+            shape = (xk.shape[0], cache.max_len) + tuple(xk.shape[2:])
+            cache.keys[self.layer_idx] = xk.new_empty(shape)
+            cache.values[self.layer_idx] = xv.new_empty(shape)
+        k, v = cache.keys[self.layer_idx], cache.values[self.layer_idx]
+        k[:, start:end] = xk
+        v[:, start:end] = xv
+        return k[:, :end], v[:, :end]
+
+
+class StaticKVCache:
+    """
+    预分配的 KV cache：每层一块 [bsz, max_len, kv_heads, head_dim] 的缓冲，按 start_pos 原地写入，
+    代替每个解码步 torch.cat 整段拷贝。缓冲在第一次写入时按实际 batch/dtype/device 分配。
+    """
+
+    def __init__(self, num_layers: int, max_len: int):
+        self.max_len = max_len
+        self.seq_len = 0
+        self.keys = [None] * num_layers
+        self.values = [None] * num_layers
+        self.layers_kv = [StaticKVLayer(self, i) for i in range(num_layers)]
+
+    def __len__(self):
+        return len(self.layers_kv)
+
+    def __getitem__(self, layer_idx):
+        return self.layers_kv[layer_idx]
+
+    def get_seq_length(self, layer_idx: int = 0):
+        # GenerationMixin 据此计算初始 cache_position
+        return self.seq_len
+
+    def reorder_cache(self, beam_idx: torch.LongTensor):
+        # beam search 每步按 beam_idx 重排
+        for buf in self.keys + self.values:
+            if buf is not None: buf.copy_(buf.index_select(0, beam_idx.to(buf.device)))
+
+
+def cache_start_pos(past_key_values) -> int:
+    if isinstance(past_key_values, StaticKVCache): return past_key_values.seq_len
+    return past_key_values[0][0].shape[1] if past_key_values[0] is not None else 0
+
+
 class Attention(nn.Module):
     def __init__(self, args: MiniMindConfig):
         super().__init__()
@@ -164,6 +259,8 @@ class Attention(nn.Module):
         self.resid_dropout = nn.Dropout(args.dropout)
         self.dropout = args.dropout
         self.flash = hasattr(torch.nn.functional, 'scaled_dot_product_attention') and args.flash_attn
+        # torch>=2.5 的 SDPA 原生支持 GQA（enable_gqa），无需展开 k/v
+        self.sdpa_gqa = tuple(int(v) for v in torch.__version__.split('.')[:2]) >= (2, 5)
         # print("WARNING: using slow attention. Flash Attention requires PyTorch >= 2.0")
 
     def forward(self,
@@ -179,43 +276,44 @@ class Attention(nn.Module):
         xv = xv.view(bsz, seq_len, self.n_local_kv_heads, self.head_dim)
 
         cos, sin = position_embeddings
-        xq, xk = apply_rotary_pos_emb(xq, xk, cos[:seq_len], sin[:seq_len])
+        if cos.dim() == 3:
+            # 按 position_ids 逐行取的 RoPE [bsz, seq_len, head_dim]（打包样本）
+            xq, xk = apply_rotary_pos_emb(xq, xk, cos, sin, unsqueeze_dim=2)
+        else:
+            xq, xk = apply_rotary_pos_emb(xq, xk, cos[:seq_len], sin[:seq_len])
 
-        # kv_cache实现
-        if past_key_value is not None:
+        # kv_cache实现：StaticKVLayer 原地写入预分配缓冲，tuple 沿用 torch.cat
+        if isinstance(past_key_value, StaticKVLayer):
+            xk, xv = past_key_value.update(xk, xv)
+        elif past_key_value is not None:
             xk = torch.cat([past_key_value[0], xk], dim=1)
             xv = torch.cat([past_key_value[1], xv], dim=1)
         past_kv = (xk, xv) if use_cache else None
 
-        xq, xk, xv = (
-            xq.transpose(1, 2),
-            repeat_kv(xk, self.n_rep).transpose(1, 2),
-            repeat_kv(xv, self.n_rep).transpose(1, 2)
-        )
-
-        if self.flash and seq_len > 1 and (attention_mask is None or torch.all(attention_mask == 1)):
-            attn_mask = (
-                None
-                if attention_mask is None
-                else attention_mask.view(bsz, 1, 1, -1).expand(bsz, self.n_local_heads, seq_len, -1).bool()
-            )
-
-            output = F.scaled_dot_product_attention(xq, xk, xv, attn_mask=attn_mask, dropout_p=self.dropout if self.training else 0.0, is_causal=True)
+        # KV 始终保持 num_key_value_heads 宽度，不再 repeat_kv 展开
+        xq, xk, xv = xq.transpose(1, 2), xk.transpose(1, 2), xv.transpose(1, 2)
+
+        # attention_mask 为 MiniMindModel.build_attn_mask 构建的 bool 掩码 [bsz, 1, seq_len, kv_len]（True 可见），None 即纯因果
+        if self.flash:
+            if self.n_rep > 1 and not self.sdpa_gqa:
+                xk, xv = xk.repeat_interleave(self.n_rep, dim=1), xv.repeat_interleave(self.n_rep, dim=1)
+            gqa_kwargs = {'enable_gqa': True} if self.n_rep > 1 and self.sdpa_gqa else {}
+            output = F.scaled_dot_product_attention(xq, xk, xv, attn_mask=attention_mask,
+                                                    dropout_p=self.dropout if self.training else 0.0,
+                                                    is_causal=attention_mask is None and seq_len > 1, **gqa_kwargs)
         else:
+            # 分组 GQA：同一 kv 头的 n_rep 个 query 头拼到行维 [bsz, kv_heads, n_rep * seq_len, head_dim]，与共享的 k/v 直接相乘
+            kv_len = xk.shape[2]
+            xq = xq.reshape(bsz, self.n_local_kv_heads, self.n_rep * seq_len, self.head_dim)
             scores = (xq @ xk.transpose(-2, -1)) / math.sqrt(self.head_dim)
-            scores = scores + torch.triu(
-                torch.full((seq_len, seq_len), float("-inf"), device=scores.device),
-                diagonal=1
-            ).unsqueeze(0).unsqueeze(0)  # scores+mask
-
+            scores = scores.view(bsz, self.n_local_kv_heads, self.n_rep, seq_len, kv_len)
             if attention_mask is not None:
-                extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
-                extended_attention_mask = (1.0 - extended_attention_mask) * -1e9
-                scores = scores + extended_attention_mask
+                scores = scores.masked_fill(~attention_mask.unsqueeze(1), float("-inf"))
 
             scores = F.softmax(scores.float(), dim=-1).type_as(xq)
             scores = self.attn_dropout(scores)
-            output = scores @ xv
+            output = (scores.view(bsz, self.n_local_kv_heads, self.n_rep * seq_len, kv_len) @ xv).view(
+                bsz, self.n_local_heads, seq_len, self.head_dim)
 
         output = output.transpose(1, 2).reshape(bsz, seq_len, -1)
         output = self.resid_dropout(self.o_proj(output))
@@ -390,12 +488,44 @@ class MiniMindModel(nn.Module):
         self.layers = nn.ModuleList([MiniMindBlock(l, config) for l in range(self.num_hidden_layers)])
         self.norm = RMSNorm(config.hidden_size, eps=config.rms_norm_eps)
 
-        freqs_cos, freqs_sin = precompute_freqs_cis(dim=config.hidden_size // config.num_attention_heads,
-                                                    end=config.max_position_embeddings, rope_base=config.rope_theta,
-                                                    rope_scaling=config.rope_scaling)
+        # 初始表覆盖训练长度，避免训练中原地扩表（DDP 同时忽略这两个 buffer，见 trainer）；推理超长时再按需扩展
+        freqs_cos, freqs_sin = self.rope_tables(min(config.max_position_embeddings, max(getattr(config, 'max_seq_len', 0) or 0, 2048)))
         self.register_buffer("freqs_cos", freqs_cos, persistent=False)
         self.register_buffer("freqs_sin", freqs_sin, persistent=False)
 
+    def build_attn_mask(self, attention_mask, seq_length: int, start_pos: int, device, position_ids=None):
+        # 因果 + padding 合并为 bool 掩码 [bsz, 1, seq_length, kv_len]（True 可见），每次 forward 构建一次、所有层共享
+        # 无 padding 时 SDPA 直接用 is_causal（无 cache 偏移）或无需掩码（单 token 解码），返回 None
+        has_pad = attention_mask is not None and not torch.all(attention_mask == 1)
+        if position_ids is None and not has_pad and (seq_length == 1 or (start_pos == 0 and self.layers[0].self_attn.flash)):
+            return None
+        kv_len = start_pos + seq_length
+        mask = (torch.arange(kv_len, device=device) <= torch.arange(start_pos, kv_len, device=device)[:, None])[None, None]
+        if position_ids is not None:
+            # 打包样本：position_ids 在每个文档开头归零，只允许看到同一文档内的 token
+            doc_ids = (position_ids == 0).cumsum(dim=1)
+            mask = mask & (doc_ids[:, None, :, None] == doc_ids[:, None, None, :])
+        if has_pad:
+            mask = mask & attention_mask[:, None, None, :].bool()
+            # 整行被遮住的位置（左 padding 的 pad token）放开，避免 softmax 出 NaN；这些位置不会被有效 token 看到
+            mask = mask | ~mask.any(-1, keepdim=True)
+        return mask
+
+    def rope_tables(self, length: int):
+        return get_rope_tables(self.config.hidden_size // self.config.num_attention_heads,
+                               self.config.max_position_embeddings, self.config.rope_theta, self.config.rope_scaling,
+                               length)
+
+    def position_embeddings(self, seq_length: int, start_pos: int, position_ids=None):
+        # position_ids（打包样本）均小于 start_pos + seq_length
+        if start_pos + seq_length > self.freqs_cos.shape[0]:
+            freqs_cos, freqs_sin = self.rope_tables(start_pos + seq_length)
+            self.freqs_cos = freqs_cos.to(self.freqs_cos)
+            self.freqs_sin = freqs_sin.to(self.freqs_sin)
+        if position_ids is not None:
+            return self.freqs_cos[position_ids], self.freqs_sin[position_ids]
+        return self.freqs_cos[start_pos:start_pos + seq_length], self.freqs_sin[start_pos:start_pos + seq_length]
+
     def forward(self,
                 input_ids: Optional[torch.Tensor] = None,
                 attention_mask: Optional[torch.Tensor] = None,
@@ -405,14 +535,13 @@ class MiniMindModel(nn.Module):
         batch_size, seq_length = input_ids.shape
         if hasattr(past_key_values, 'layers'): past_key_values = None
         past_key_values = past_key_values or [None] * len(self.layers)
-        start_pos = past_key_values[0][0].shape[1] if past_key_values[0] is not None else 0
+        start_pos = cache_start_pos(past_key_values)
 
         hidden_states = self.dropout(self.embed_tokens(input_ids))
-
-        position_embeddings = (
-            self.freqs_cos[start_pos:start_pos + seq_length],
-            self.freqs_sin[start_pos:start_pos + seq_length]
-        )
+        # 打包样本的 position_ids 走 kwargs 而不放进签名：否则 GenerationMixin 会按 attention_mask 自动生成并传入
+        position_ids = kwargs.get('position_ids')
+        attn_mask = self.build_attn_mask(attention_mask, seq_length, start_pos, hidden_states.device, position_ids)
+        position_embeddings = self.position_embeddings(seq_length, start_pos, position_ids)
 
         presents = []
         for layer_idx, (layer, past_key_value) in enumerate(zip(self.layers, past_key_values)):
@@ -421,9 +550,12 @@ class MiniMindModel(nn.Module):
                 position_embeddings,
                 past_key_value=past_key_value,
                 use_cache=use_cache,
-                attention_mask=attention_mask
+                attention_mask=attn_mask
             )
             presents.append(present)
+        if isinstance(past_key_values, StaticKVCache):
+            past_key_values.seq_len = start_pos + seq_length
+            presents = past_key_values
 
         hidden_states = self.norm(hidden_states)
 
@@ -453,6 +585,8 @@ class MiniMindForCausalLM(PreTrainedModel, GenerationMixin):
                 past_key_values: Optional[List[Tuple[torch.Tensor, torch.Tensor]]] = None,
                 use_cache: bool = False,
                 logits_to_keep: Union[int, torch.Tensor] = 0,
+                labels: Optional[torch.Tensor] = None,
+                loss_mask: Optional[torch.Tensor] = None,
                 **args):
         h, past_kvs, aux_loss = self.model(
             input_ids=input_ids,
@@ -461,10 +595,29 @@ class MiniMindForCausalLM(PreTrainedModel, GenerationMixin):
             use_cache=use_cache,
             **args
         )
-        slice_indices = slice(-logits_to_keep, None) if isinstance(logits_to_keep, int) else logits_to_keep
-        logits = self.lm_head(h[:, slice_indices, :])
+        loss, logits = self.lm_loss_or_logits(h, logits_to_keep, labels, loss_mask)
         self.OUT.__setitem__('last_hidden_state', h)
+        self.OUT.__setitem__('loss', loss)
         self.OUT.__setitem__('logits', logits)
         self.OUT.__setitem__('aux_loss', aux_loss)
         self.OUT.__setitem__('past_key_values', past_kvs)
         return self.OUT
+
+    def lm_loss_or_logits(self, h, logits_to_keep=0, labels=None, loss_mask=None):
+        # 传入 labels（已移位的目标，同训练中的 Y）时只在 loss_mask 位置分块算 loss，不返回 logits
+        if labels is not None:
+            loss_mask = torch.ones_like(labels) if loss_mask is None else loss_mask
+            return masked_lm_loss(h, self.lm_head.weight, labels, loss_mask), None
+        slice_indices = slice(-logits_to_keep, None) if isinstance(logits_to_keep, int) else logits_to_keep
+        return None, self.lm_head(h[:, slice_indices, :])
+
+    def _prepare_cache_for_generation(self, generation_config, model_kwargs, generation_mode, batch_size,
+                                      max_cache_length, *args, **kwargs):
+        # 未显式传入 cache 时，按 generate 的 max_length 预分配 StaticKVCache（替代 HF 默认的 DynamicCache）
+        if (not getattr(self.config, 'static_kv_cache', False) or model_kwargs.get('past_key_values') is not None
+                or generation_config.use_cache is False or generation_config.cache_implementation is not None
+                or generation_mode not in (GenerationMode.GREEDY_SEARCH, GenerationMode.SAMPLE,
+                                           GenerationMode.BEAM_SEARCH, GenerationMode.BEAM_SAMPLE)):
+            return super()._prepare_cache_for_generation(generation_config, model_kwargs, generation_mode,
+                                                         batch_size, max_cache_length, *args, **kwargs)
+        model_kwargs['past_key_values'] = StaticKVCache(self.config.num_hidden_layers, max_cache_length)
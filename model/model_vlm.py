@@ -1,11 +1,17 @@
+import hashlib
+import math
 import os
+from collections import OrderedDict
 
+import numpy as np
 import torch
+import torch.nn.functional as F
+from PIL import Image
 import warnings
 from .model_minimind import *
 from typing import Optional, Tuple, List
 from torch import nn
-from transformers import CLIPProcessor, CLIPModel
+from transformers import CLIPImageProcessor, CLIPVisionModel
 from typing import List
 
 warnings.filterwarnings('ignore')
@@ -16,99 +22,268 @@ class VLMConfig(MiniMindConfig):
 
     def __init__(
             self,
-            image_special_token: str = '@' * 196,
-            image_ids: List = [34] * 196,
+            image_special_token: str = None,
+            image_ids: List = None,
+            image_token_len: int = 196,
+            vision_compress: str = 'pool',
             **kwargs,
     ):
-        self.image_special_token = image_special_token
-        self.image_ids = image_ids
+        # 每张图在序列中占 image_token_len 个位置：196 为 14×14 patch 不压缩，
+        # 更少时由 VisionProj 按 vision_compress（pool / resampler）压缩，占位符长度随之变化
+        self.image_token_len = image_token_len
+        self.vision_compress = vision_compress
+        self.image_special_token = image_special_token or '@' * image_token_len
+        self.image_ids = image_ids or [34] * image_token_len
         super().__init__(**kwargs)
 
 class VisionProj(nn.Module):
-    def __init__(self, ve_hidden_size=768, hidden_size=512):
+    def __init__(self, ve_hidden_size=768, hidden_size=512, num_tokens=196, compress='pool', num_patches=196):
         super().__init__()
         self.ve_hidden_size = ve_hidden_size
         self.hidden_size = hidden_size
+        self.num_tokens = num_tokens
+        self.compress = compress if num_tokens != num_patches else None
+        if self.compress == 'pool':
+            # patch 网格做 2D 自适应平均池化，num_tokens 需为平方数（49 = 7×7，16 = 4×4）
+            self.grid, self.out_grid = math.isqrt(num_patches), math.isqrt(num_tokens)
+            assert self.out_grid ** 2 == num_tokens, f'pool 压缩要求 image_token_len 为平方数: {num_tokens}'
+        elif self.compress == 'resampler':
+            # num_tokens 个可学习 query 对全部 patch 做一次 cross-attention
+            self.query = nn.Parameter(torch.randn(num_tokens, ve_hidden_size) * 0.02)
+            self.resampler = nn.MultiheadAttention(ve_hidden_size, num_heads=8, batch_first=True)
+        elif self.compress is not None:
+            raise ValueError(f'未知的 vision_compress: {compress}')
         self.vision_proj = nn.Sequential(
             nn.Linear(self.ve_hidden_size, self.hidden_size)
         )
 
+    def compress_tokens(self, image_encoders):
+        # [..., num_patches, ve_hidden_size] -> [..., num_tokens, ve_hidden_size]
+        lead = image_encoders.shape[:-2]
+        x = image_encoders.reshape(-1, *image_encoders.shape[-2:])
+        if self.compress == 'pool':
+            x = x.transpose(1, 2).unflatten(2, (self.grid, self.grid))
+            x = F.adaptive_avg_pool2d(x, self.out_grid).flatten(2).transpose(1, 2)
+        else:
+            x = self.resampler(self.query.expand(x.size(0), -1, -1).to(x.dtype), x, x, need_weights=False)[0]
+        return x.reshape(*lead, self.num_tokens, self.ve_hidden_size)
+
     def forward(self, image_encoders):
+        if self.compress is not None:
+            image_encoders = self.compress_tokens(image_encoders)
         vision_proj = self.vision_proj(image_encoders)
         return vision_proj
 
 
+class VisionEmbedCache:
+    """推理侧图像特征缓存：按图像内容哈希保存 vision_proj 之后的特征 [T, H]，超出 max_bytes 时按 LRU 淘汰。
+
+    web_demo_vlm.py 与 eval_vlm.py 共用；save/load 可跨进程复用，tag（权重标识）不一致时不加载。
+    """
+
+    def __init__(self, max_bytes=256 * 1024 ** 2, tag=''):
+        self.max_bytes = max_bytes
+        self.tag = tag
+        self._items = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def content_key(image):
+        # 路径 / bytes 直接对文件内容取哈希（命中时无需解码），PIL 图像对像素取哈希
+        h = hashlib.sha1()
+        if isinstance(image, (str, os.PathLike)):
+            with open(image, 'rb') as f:
+                h.update(f.read())
+        elif isinstance(image, bytes):
+            h.update(image)
+        else:
+            h.update(f'{image.mode}{image.size}'.encode())
+            h.update(image.tobytes())
+        return h.hexdigest()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        value = self._items.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        value = value.detach()
+        if key in self._items:
+            old = self._items.pop(key)
+            self.nbytes -= old.numel() * old.element_size()
+        self._items[key] = value
+        self.nbytes += value.numel() * value.element_size()
+        while self.nbytes > self.max_bytes and len(self._items) > 1:
+            _, old = self._items.popitem(last=False)
+            self.nbytes -= old.numel() * old.element_size()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'items': len(self._items), 'bytes': self.nbytes}
+
+    def save(self, path):
+        torch.save({'tag': self.tag, 'items': [(k, v.cpu()) for k, v in self._items.items()]}, path)
+
+    def load(self, path, device='cpu'):
+        if not os.path.exists(path):
+            return
+        data = torch.load(path, map_location=device)
+        if data.get('tag') != self.tag:
+            return
+        for key, value in data['items']:
+            self.put(key, value)
+
+
 # 继承自语言模型
 class MiniMindVLM(MiniMindForCausalLM):
     config_class = VLMConfig
 
-    def __init__(self, params: VLMConfig = None, vision_model_path="./model/vision_model/clip-vit-base-patch16"):
+    def __init__(self, params: VLMConfig = None, vision_model_path="./model/vision_model/clip-vit-base-patch16",
+                 vision_int8=False):
         super().__init__(params)
         if not params: params = VLMConfig()
         self.params = params
-        self.vision_encoder, self.processor = self.__class__.get_vision_model(vision_model_path)
-        self.vision_proj = VisionProj(hidden_size=params.hidden_size)
+        self.vision_encoder, self.processor = self.__class__.get_vision_model(vision_model_path, int8=vision_int8)
+        num_patches = 196
+        if self.vision_encoder is not None:
+            vision_config = self.vision_encoder.config
+            num_patches = (vision_config.image_size // vision_config.patch_size) ** 2
+        self.vision_proj = VisionProj(hidden_size=params.hidden_size, num_tokens=params.image_token_len,
+                                      compress=params.vision_compress, num_patches=num_patches)
 
     @staticmethod
-    def get_vision_model(model_path: str):
+    def get_vision_model(model_path: str, int8: bool = False):
         from transformers import logging as hf_logging
         hf_logging.set_verbosity_error()
         if not os.path.exists(model_path):
             return None, None
-        model = CLIPModel.from_pretrained(model_path)
-        processor = CLIPProcessor.from_pretrained(model_path)
+        # 只构建 vision tower（从完整 CLIP 权重中取 vision_model.*），不加载 text encoder 和 tokenizer
+        model = CLIPVisionModel.from_pretrained(model_path)
+        processor = CLIPImageProcessor.from_pretrained(model_path)
         # 冻结 vision_encoder 的所有参数
         for param in model.parameters():
             param.requires_grad = False
+        if int8:
+            # CPU 推理：ViT 中的 nn.Linear 换成动态 int8 量化（权重 int8，激活按 batch 动态量化），仅支持 CPU
+            model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
         return model.eval(), processor
 
     @staticmethod
     def image2tensor(image, processor):
-        if image.mode in ['RGBA', 'LA']: image = image.convert('RGB')
-        inputs = processor(images=image, return_tensors="pt")['pixel_values']
-        return inputs
+        return MiniMindVLM.images2tensor([image], processor)
+
+    @staticmethod
+    def images2tensor(images, processor, draft=False):
+        # 与 CLIPImageProcessor 一致：短边 resize（PIL 同一插值）→ center crop → rescale → normalize，
+        # 后两步对整批 uint8 张量一次完成，返回 [N, 3, H, W]
+        # draft=True 仅供推理显式开启：大 JPEG 解码更快，但像素与全分辨率解码不同；训练与特征抽取保持默认
+        ip = getattr(processor, 'image_processor', processor)
+        short = ip.size['shortest_edge']
+        crop_h, crop_w = ip.crop_size['height'], ip.crop_size['width']
+        crops = []
+        for image in images:
+            if draft and image.format == 'JPEG':
+                # JPEG 在解码阶段按 2 的幂缩小，保留短边 >= 2 倍目标，使与全分辨率 resize 的误差可控
+                scale = 2 * short / min(image.size)
+                if scale < 1: image.draft('RGB', (int(image.size[0] * scale), int(image.size[1] * scale)))
+            if image.mode != 'RGB': image = image.convert('RGB')
+            w, h = image.size
+            new_w, new_h = (short, int(short * h / w)) if w <= h else (int(short * w / h), short)
+            image = np.asarray(image.resize((new_w, new_h), resample=ip.resample))
+            top, left = (new_h - crop_h) // 2, (new_w - crop_w) // 2
+            crops.append(image[top:top + crop_h, left:left + crop_w])
+        pixels = torch.from_numpy(np.stack(crops)).permute(0, 3, 1, 2).float().mul_(1 / 255)
+        mean = torch.tensor(ip.image_mean, dtype=torch.float32).view(1, 3, 1, 1)
+        std = torch.tensor(ip.image_std, dtype=torch.float32).view(1, 3, 1, 1)
+        return (pixels - mean) / std
 
     @staticmethod
     def get_image_embeddings(image_tensors, vision_model):
         with torch.no_grad():
             outputs = vision_model.vision_model(pixel_values=image_tensors)
-        img_embedding = outputs.last_hidden_state[:, 1:, :].squeeze()
+        img_embedding = outputs.last_hidden_state[:, 1:, :]
         return img_embedding
 
-    def count_vision_proj(self, tokens, h, vision_tensors=None, seqlen=512):
-        def find_indices(tokens, image_ids):
-            image_ids_tensor = torch.tensor(image_ids).to(tokens.device)
-            len_image_ids = len(image_ids)
-            if len_image_ids > tokens.size(1):
-                return None
-            tokens_view = tokens.unfold(1, len_image_ids, 1)
-            matches = (tokens_view == image_ids_tensor).all(dim=2)
-            return {
-                batch_idx: [(idx.item(), idx.item() + len_image_ids - 1) for idx in
-                            matches[batch_idx].nonzero(as_tuple=True)[0]]
-                for batch_idx in range(tokens.size(0)) if matches[batch_idx].any()
-            } or None
-
-        image_indices = find_indices(tokens, self.params.image_ids)
-        if vision_tensors is not None and image_indices:
-            vision_proj = self.vision_proj(vision_tensors)
-            if len(vision_proj.shape) == 3:
-                vision_proj = vision_proj.unsqueeze(0)
-            new_h = []
-            for i in range(h.size(0)):
-                if i in image_indices:
-                    h_i = h[i]
-                    img_idx = 0
-                    for start_idx, end_idx in image_indices[i]:
-                        if img_idx < vision_proj.size(1):
-                            h_i = torch.cat((h_i[:start_idx], vision_proj[i][img_idx], h_i[end_idx + 1:]), dim=0)[
-                                  :seqlen]
-                            img_idx += 1
-                    new_h.append(h_i)
-                else:
-                    new_h.append(h[i])
-            return torch.stack(new_h, dim=0)
-        return h
+    def encode_images(self, pixel_values, image_mask=None):
+        # [bs, num, (1,) c, h, w] 展平后一次送入 vision encoder，返回 [bs, num, 196, 768]
+        # image_mask [bs, num] 标记有效图像槽位（每个样本图像数不同时补齐的槽位不参与计算）
+        if pixel_values.dim() == 6:
+            pixel_values = pixel_values.squeeze(2)
+        bs, num = pixel_values.shape[:2]
+        pixel_values = pixel_values.flatten(0, 1)
+        if image_mask is None:
+            return MiniMindVLM.get_image_embeddings(pixel_values, self.vision_encoder).unflatten(0, (bs, num))
+        image_mask = image_mask.flatten()
+        if not image_mask.any():
+            return None
+        img_embedding = MiniMindVLM.get_image_embeddings(pixel_values[image_mask], self.vision_encoder)
+        vision_tensors = img_embedding.new_zeros(bs * num, *img_embedding.shape[1:])
+        vision_tensors[image_mask] = img_embedding
+        return vision_tensors.unflatten(0, (bs, num))
+
+    @staticmethod
+    def image_token_mask(input_ids, image_ids):
+        # image_ids 为同一 token 重复 n 次：每段连续的 image token 从段首按 n 切分，完整的一份对应一张图
+        n = len(image_ids)
+        is_img = input_ids == image_ids[0]
+        seq_len = input_ids.size(1)
+        idx = torch.arange(seq_len, device=input_ids.device).expand_as(input_ids)
+        run_start = torch.where(is_img, -1, idx).cummax(dim=1).values + 1
+        run_end = torch.flip(torch.cummin(torch.flip(torch.where(is_img, seq_len, idx), [1]), dim=1).values, [1])
+        return is_img & (((idx - run_start) // n + 1) * n <= run_end - run_start)
+
+    def vision_cache_tag(self):
+        # 投影后的特征由（冻结的）vision encoder 与 vision_proj 决定：对 vision_proj 权重和 encoder 的模块类型
+        # （区分 fp32 / int8）取哈希，作为 VisionEmbedCache 的 tag
+        h = hashlib.sha1()
+        for name, param in self.vision_proj.state_dict().items():
+            h.update(name.encode())
+            h.update(param.detach().float().cpu().numpy().tobytes())
+        if self.vision_encoder is not None:
+            h.update(' '.join(sorted({f'{type(m).__module__}.{type(m).__name__}' for m in self.vision_encoder.modules()})).encode())
+        return h.hexdigest()[:16]
+
+    @torch.no_grad()
+    def embed_images(self, images, cache=None, draft=False):
+        # 推理用：图像（路径 / PIL）列表 -> 投影后的视觉特征 [1, num, T, H]；cache 命中时跳过解码、预处理和 vision encoder
+        # draft 透传给 images2tensor；开启时 cache 的 tag 应与关闭时区分
+        embeds = []
+        for image in images:
+            key = cache.content_key(image) if cache is not None else None
+            embed = cache.get(key) if cache is not None else None
+            if embed is None:
+                if isinstance(image, (str, os.PathLike)):
+                    image = Image.open(image)
+                pixel_values = MiniMindVLM.images2tensor([image], self.processor, draft=draft).to(self.device)
+                embed = self.vision_proj(self.encode_images(pixel_values.unsqueeze(0)))[0, 0]
+                if cache is not None:
+                    cache.put(key, embed)
+            embeds.append(embed)
+        return torch.stack(embeds).unsqueeze(0)
+
+    def count_vision_proj(self, tokens, h, vision_tensors=None, image_pos=None, projected=False, image_mask=None):
+        if vision_tensors is None:
+            return h
+        if image_pos is None:
+            image_pos = self.image_token_mask(tokens, self.params.image_ids)
+        n = len(self.params.image_ids)
+        # 每个样本第 k 段 image token 对应第 k 个图像槽位，超出该样本有效图像数（image_mask，补齐槽位在后）的段保持原 embedding
+        num_slots = vision_tensors.size(1) if image_mask is None else image_mask.sum(dim=1, keepdim=True)
+        image_pos = image_pos & ((image_pos.cumsum(dim=1) - 1) // n < num_slots)
+        num_images = image_pos.sum(dim=1) // n
+        if not num_images.any():
+            return h
+        used = torch.arange(vision_tensors.size(1), device=h.device) < num_images.unsqueeze(1)
+        vision_proj = vision_tensors[used] if projected else self.vision_proj(vision_tensors[used])
+        return h.masked_scatter(image_pos.unsqueeze(-1), vision_proj.to(h.dtype))
 
     def forward(self,
                 input_ids: Optional[torch.Tensor] = None,
@@ -117,30 +292,36 @@ class MiniMindVLM(MiniMindForCausalLM):
                 use_cache: bool = False,
                 logits_to_keep: Union[int, torch.Tensor] = 0,
                 pixel_values: Optional[torch.FloatTensor] = None,
+                vision_features: Optional[torch.Tensor] = None,
+                image_mask: Optional[torch.Tensor] = None,
+                image_pos: Optional[torch.Tensor] = None,
+                vision_embeds: Optional[torch.Tensor] = None,
+                labels: Optional[torch.Tensor] = None,
+                loss_mask: Optional[torch.Tensor] = None,
                 **args):
         batch_size, seq_length = input_ids.shape
         if hasattr(past_key_values, 'layers'): past_key_values = None
         past_key_values = past_key_values or [None] * len(self.model.layers)
-        start_pos = past_key_values[0][0].shape[1] if past_key_values[0] is not None else 0
+        start_pos = cache_start_pos(past_key_values)
 
         hidden_states = self.model.dropout(self.model.embed_tokens(input_ids))
 
-        if pixel_values is not None and start_pos == 0:
-            if len(pixel_values.shape) == 6:
-                pixel_values = pixel_values.squeeze(2)
-            bs, num, c, im_h, im_w = pixel_values.shape
-            stack_dim = 1 if bs > 1 else 0
-            vision_tensors = torch.stack([
-                MiniMindVLM.get_image_embeddings(pixel_values[:, i, :, :, :], self.vision_encoder)
-                for i in range(num)
-            ], dim=stack_dim)
+        if start_pos == 0 and vision_embeds is not None:
+            # 已投影的视觉特征 [bs, num, T, H]（embed_images / VisionEmbedCache），跳过 vision encoder 和 vision_proj
+            hidden_states = self.count_vision_proj(tokens=input_ids, h=hidden_states, vision_tensors=vision_embeds,
+                                                   image_pos=image_pos, projected=True, image_mask=image_mask)
+        elif start_pos == 0 and (vision_features is not None or pixel_values is not None):
+            if vision_features is not None:
+                # 预提取的 CLIP patch 特征 [bs, num, 196, 768]，跳过 vision encoder
+                vision_tensors = vision_features.to(self.vision_proj.vision_proj[0].weight.dtype)
+            else:
+                vision_tensors = self.encode_images(pixel_values, image_mask)
             hidden_states = self.count_vision_proj(tokens=input_ids, h=hidden_states, vision_tensors=vision_tensors,
-                                                   seqlen=input_ids.shape[1])
+                                                   image_pos=image_pos, image_mask=image_mask)
 
-        position_embeddings = (
-            self.model.freqs_cos[start_pos:start_pos + seq_length],
-            self.model.freqs_sin[start_pos:start_pos + seq_length]
-        )
+        position_ids = args.get('position_ids')
+        attn_mask = self.model.build_attn_mask(attention_mask, seq_length, start_pos, hidden_states.device, position_ids)
+        position_embeddings = self.model.position_embeddings(seq_length, start_pos, position_ids)
 
         presents = []
         for layer_idx, (layer, past_key_value) in enumerate(zip(self.model.layers, past_key_values)):
@@ -149,9 +330,12 @@ class MiniMindVLM(MiniMindForCausalLM):
                 position_embeddings,
                 past_key_value=past_key_value,
                 use_cache=use_cache,
-                attention_mask=attention_mask
+                attention_mask=attn_mask
             )
             presents.append(present)
+        if isinstance(past_key_values, StaticKVCache):
+            past_key_values.seq_len = start_pos + seq_length
+            presents = past_key_values
 
         hidden_states = self.model.norm(hidden_states)
 
@@ -160,9 +344,9 @@ class MiniMindVLM(MiniMindForCausalLM):
             for layer in self.model.layers
             if isinstance(layer.mlp, MOEFeedForward)
         )
-        slice_indices = slice(-logits_to_keep, None) if isinstance(logits_to_keep, int) else logits_to_keep
-        logits = self.lm_head(hidden_states[:, slice_indices, :])
+        loss, logits = self.lm_loss_or_logits(hidden_states, logits_to_keep, labels, loss_mask)
         self.OUT.__setitem__('last_hidden_state', hidden_states)
+        self.OUT.__setitem__('loss', loss)
         self.OUT.__setitem__('logits', logits)
         self.OUT.__setitem__('aux_loss', aux_loss)
         self.OUT.__setitem__('past_key_values', presents)
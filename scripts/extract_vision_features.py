@@ -0,0 +1,65 @@
+import os
+import sys
+
+__package__ = "scripts"
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import argparse
+import json
+import numpy as np
+import torch
+from PIL import Image
+from model.model_vlm import MiniMindVLM
+
+
+def collect_image_names(data_paths):
+    # 去重并保持首次出现顺序，多图样本以 ',' 分隔
+    names = {}
+    for data_path in data_paths:
+        with open(data_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                for name in json.loads(line)['image'].split(','):
+                    names.setdefault(name.strip(), None)
+    return list(names)
+
+
+def extract_vision_features(image_names, images_path, out_prefix, vision_model_path, batch_size=64, device='cpu'):
+    vision_model, processor = MiniMindVLM.get_vision_model(vision_model_path)
+    assert vision_model is not None, f'未找到 vision model: {vision_model_path}'
+    vision_model = vision_model.to(device)
+    cfg = vision_model.config
+    num_patches = (cfg.image_size // cfg.patch_size) ** 2
+    shape = (len(image_names), num_patches, cfg.hidden_size)
+
+    features = np.memmap(f'{out_prefix}.features.bin', dtype=np.float16, mode='w+', shape=shape)
+    for start in range(0, len(image_names), batch_size):
+        batch = image_names[start:start + batch_size]
+        pixel_values = MiniMindVLM.images2tensor([Image.open(os.path.join(images_path, name)) for name in batch],
+                                                 processor).to(device)
+        emb = MiniMindVLM.get_image_embeddings(pixel_values, vision_model)
+        features[start:start + len(batch)] = emb.half().cpu().numpy()
+        print(f'{start + len(batch)}/{len(image_names)}', end='\r')
+    features.flush()
+    del features
+
+    with open(f'{out_prefix}.index.json', 'w', encoding='utf-8') as f:
+        json.dump({'shape': list(shape), 'vision_model': os.path.basename(os.path.normpath(vision_model_path)),
+                   'images': {name: i for i, name in enumerate(image_names)}}, f, ensure_ascii=False)
+    return shape
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="MiniMind-V 预提取冻结 CLIP 的 patch 特征（float16 memmap）")
+    parser.add_argument("--data_path", type=str, nargs='+', default=["../dataset/sft_data.jsonl"], help="输入 jsonl 路径（可多个，图片去重）")
+    parser.add_argument("--images_path", type=str, default="../dataset/sft_images", help="图像目录")
+    parser.add_argument("--out_prefix", type=str, default="../dataset/clip_features", help="输出前缀（.features.bin / .index.json）")
+    parser.add_argument("--vision_model_path", type=str, default="../model/vision_model/clip-vit-base-patch16", help="CLIP 模型路径")
+    parser.add_argument("--batch_size", type=int, default=64, help="每批图像数")
+    parser.add_argument("--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu", help="运行设备")
+    args = parser.parse_args()
+
+    image_names = collect_image_names(args.data_path)
+    shape = extract_vision_features(image_names, args.images_path, args.out_prefix, args.vision_model_path,
+                                    batch_size=args.batch_size, device=args.device)
+    print(f'已提取 {shape[0]} 张图像特征 {tuple(shape[1:])}: {args.out_prefix}.*')
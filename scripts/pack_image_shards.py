@@ -0,0 +1,69 @@
+import os
+import sys
+
+__package__ = "scripts"
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import argparse
+import json
+from multiprocessing import Pool
+import numpy as np
+from PIL import Image
+from transformers import CLIPImageProcessor
+from scripts.extract_vision_features import collect_image_names
+
+_processor = None
+
+
+def _init_worker(vision_model_path):
+    global _processor
+    _processor = CLIPImageProcessor.from_pretrained(vision_model_path)
+
+
+def _resize_crop(path):
+    # 只做 CLIPImageProcessor 的 resize + center crop，rescale/normalize 留给 ImageShardStore
+    image = Image.open(path)
+    if image.mode in ['RGBA', 'LA']: image = image.convert('RGB')
+    pixels = _processor(images=image, do_rescale=False, do_normalize=False, return_tensors='np')['pixel_values'][0]
+    return np.clip(np.rint(pixels), 0, 255).astype(np.uint8).transpose(1, 2, 0)
+
+
+def pack_image_shards(image_names, images_path, out_prefix, vision_model_path, shard_size=4096, num_workers=1):
+    processor = CLIPImageProcessor.from_pretrained(vision_model_path)
+    size = processor.crop_size['height']
+    shard_sizes = [min(shard_size, len(image_names) - i) for i in range(0, len(image_names), shard_size)]
+    paths = [os.path.join(images_path, name) for name in image_names]
+
+    shard = None
+    with Pool(num_workers, initializer=_init_worker, initargs=(vision_model_path,)) as pool:
+        for i, pixels in enumerate(pool.imap(_resize_crop, paths, chunksize=16)):
+            shard_id, row = divmod(i, shard_size)
+            if row == 0:
+                if shard is not None: shard.flush()
+                shard = np.memmap(f'{out_prefix}-{shard_id:05d}.bin', dtype=np.uint8, mode='w+',
+                                  shape=(shard_sizes[shard_id], size, size, 3))
+            shard[row] = pixels
+            print(f'{i + 1}/{len(paths)}', end='\r')
+    if shard is not None: shard.flush()
+
+    with open(f'{out_prefix}.index.json', 'w', encoding='utf-8') as f:
+        json.dump({'size': size, 'image_mean': list(processor.image_mean), 'image_std': list(processor.image_std),
+                   'shards': shard_sizes,
+                   'images': {name: list(divmod(i, shard_size)) for i, name in enumerate(image_names)}},
+                  f, ensure_ascii=False)
+    return len(image_names), len(shard_sizes)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="MiniMind-V 图像预处理分片（224×224 uint8，mmap 读取）")
+    parser.add_argument("--data_path", type=str, nargs='+', default=["../dataset/sft_data.jsonl"], help="输入 jsonl 路径（可多个，图片去重）")
+    parser.add_argument("--images_path", type=str, default="../dataset/sft_images", help="图像目录")
+    parser.add_argument("--out_prefix", type=str, default="../dataset/image_shards", help="输出前缀（-NNNNN.bin / .index.json）")
+    parser.add_argument("--vision_model_path", type=str, default="../model/vision_model/clip-vit-base-patch16", help="CLIP 模型路径（读取预处理配置）")
+    parser.add_argument("--shard_size", type=int, default=4096, help="每个分片的图像数")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count() or 1, help="解码进程数")
+    args = parser.parse_args()
+
+    image_names = collect_image_names(args.data_path)
+    num_images, num_shards = pack_image_shards(image_names, args.images_path, args.out_prefix, args.vision_model_path,
+                                               shard_size=args.shard_size, num_workers=args.num_workers)
+    print(f'已打包 {num_images} 张图像，{num_shards} 个分片: {args.out_prefix}.*')
@@ -0,0 +1,25 @@
+import os
+import sys
+
+__package__ = "scripts"
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import argparse
+from transformers import AutoTokenizer
+from dataset.lm_dataset import pack_vlm_dataset
+from model.model_vlm import VLMConfig
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="MiniMind-V 预分词打包（memmap 格式）")
+    parser.add_argument("--data_path", type=str, default="../dataset/sft_data.jsonl", help="输入 jsonl 路径")
+    parser.add_argument("--out_prefix", type=str, default=None, help="输出前缀（默认与 data_path 同名去掉 .jsonl）")
+    parser.add_argument("--tokenizer_path", type=str, default="../model", help="tokenizer 路径")
+    parser.add_argument('--max_seq_len', default=1536, type=int, help="训练的最大截断长度（需与训练时一致）")
+    parser.add_argument('--image_tokens', default=196, type=int, help="每张图的视觉token数（需与训练时一致）")
+    args = parser.parse_args()
+
+    out_prefix = args.out_prefix or os.path.splitext(args.data_path)[0]
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path)
+    num_samples, num_tokens = pack_vlm_dataset(args.data_path, out_prefix, tokenizer, max_length=args.max_seq_len,
+                                               image_special_token=VLMConfig(image_token_len=args.image_tokens).image_special_token)
+    print(f'已打包 {num_samples} 条样本，共 {num_tokens} 个 token: {out_prefix}.*')
@@ -11,7 +11,7 @@ from queue import Queue
 from threading import Thread
 from PIL import Image
 from transformers import AutoTokenizer, AutoModelForCausalLM, TextStreamer
-from model.model_vlm import MiniMindVLM, VLMConfig
+from model.model_vlm import MiniMindVLM, VLMConfig, VisionEmbedCache
 from transformers import logging as hf_logging
 
 hf_logging.set_verbosity_error()
@@ -23,12 +23,14 @@ def init_model(lm_config):
     if 'model' in args.load_from:
         moe_path = '_moe' if lm_config.use_moe else ''
         ckp = f'../{args.save_dir}/{args.weight}_{lm_config.hidden_size}{moe_path}.pth'
-        model = MiniMindVLM(lm_config, vision_model_path="../model/vision_model/clip-vit-base-patch16")
+        model = MiniMindVLM(lm_config, vision_model_path="../model/vision_model/clip-vit-base-patch16",
+                            vision_int8=bool(args.vision_int8))
         state_dict = torch.load(ckp, map_location=args.device)
         model.load_state_dict({k: v for k, v in state_dict.items() if 'mask' not in k}, strict=False)
     else:
         model = AutoModelForCausalLM.from_pretrained(args.load_from, trust_remote_code=True)
-        model.vision_encoder, model.processor = MiniMindVLM.get_vision_model("../model/vision_model/clip-vit-base-patch16")
+        model.vision_encoder, model.processor = MiniMindVLM.get_vision_model("../model/vision_model/clip-vit-base-patch16",
+                                                                             int8=bool(args.vision_int8))
 
     print(f'VLM参数量：{sum(p.numel() for p in model.parameters() if p.requires_grad) / 1e6:.3f} 百万')
 
@@ -50,8 +52,14 @@ class CustomStreamer(TextStreamer):
 
 def chat(prompt, current_image_path):
     global temperature, top_p
-    image = Image.open(current_image_path).convert('RGB')
-    pixel_values = MiniMindVLM.image2tensor(image, preprocess).to(model.device).unsqueeze(0)
+    if vision_cache is not None:
+        # 同一张图的追问直接命中缓存，跳过解码、预处理和 vision encoder
+        image_inputs = {'vision_embeds': model.embed_images([current_image_path], cache=vision_cache,
+                                                            draft=bool(args.draft_decode))}
+    else:
+        image = Image.open(current_image_path)
+        image_inputs = {'pixel_values': MiniMindVLM.images2tensor([image], preprocess, draft=bool(args.draft_decode))
+                        .to(model.device).unsqueeze(0)}
 
     prompt = f'{lm_config.image_special_token}\n{prompt}'
     messages = [{"role": "user", "content": prompt}]
@@ -82,7 +90,7 @@ def chat(prompt, current_image_path):
                 pad_token_id=tokenizer.pad_token_id,
                 eos_token_id=tokenizer.eos_token_id,
                 streamer=streamer,
-                pixel_values=pixel_values
+                **image_inputs
             )
 
         Thread(target=_generate).start()
@@ -189,10 +197,21 @@ if __name__ == '__main__':
     parser.add_argument('--num_hidden_layers', default=8, type=int, help="隐藏层数量（Small=8, Base=16）")
     parser.add_argument('--max_seq_len', default=8192, type=int, help="最大序列长度")
     parser.add_argument('--use_moe', default=0, type=int, choices=[0, 1], help="是否使用MoE架构（0=否，1=是）")
+    parser.add_argument('--image_tokens', default=196, type=int, help="每张图的视觉token数（196=不压缩，49/16等需与训练时一致）")
+    parser.add_argument('--vision_compress', default='pool', type=str, choices=['pool', 'resampler'], help="视觉token压缩方式（image_tokens<196时生效）")
     parser.add_argument('--stream', default=1, type=int, choices=[0, 1], help="是否使用流式输出（0=否，1=是）")
+    parser.add_argument('--vision_int8', default=0, type=int, choices=[0, 1], help="vision encoder 是否使用动态int8量化（0=否，1=是，仅CPU）")
+    parser.add_argument('--vision_cache', default='', type=str, help="预热用的图像特征缓存文件（eval_vlm.py --vision_cache 生成）")
+    parser.add_argument('--vision_cache_mb', default=256, type=int, help="图像特征缓存上限（MB，LRU淘汰）")
+    parser.add_argument('--draft_decode', default=0, type=int, choices=[0, 1], help="大JPEG是否按目标尺寸降采样解码（0=否，与训练一致，1=是，更快但像素有偏差）")
     args = parser.parse_args()
 
     lm_config = VLMConfig(hidden_size=args.hidden_size, num_hidden_layers=args.num_hidden_layers,
-                          max_seq_len=args.max_seq_len, use_moe=bool(args.use_moe))
+                          max_seq_len=args.max_seq_len, use_moe=bool(args.use_moe),
+                          image_token_len=args.image_tokens, vision_compress=args.vision_compress)
     model, tokenizer, vision_model, preprocess = init_model(lm_config)
+    # 旧版 remote code 导出的 transformers 模型没有 embed_images，回退到 pixel_values 路径（不使用特征缓存）
+    vision_cache = VisionEmbedCache(max_bytes=args.vision_cache_mb * 1024 ** 2, tag=model.vision_cache_tag() + ('-draft' if args.draft_decode else '')) \
+        if hasattr(model, 'embed_images') else None
+    if args.vision_cache and vision_cache is not None: vision_cache.load(args.vision_cache, device=args.device)
     launch_gradio_server(server_name="0.0.0.0", server_port=8888)
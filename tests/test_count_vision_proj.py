@@ -0,0 +1,67 @@
+import torch
+
+from model.model_vlm import MiniMindVLM, VLMConfig
+
+
+def build_model():
+    torch.manual_seed(0)
+    # 不加载 vision encoder，只测试 image token 与视觉特征的对齐
+    return MiniMindVLM(VLMConfig(hidden_size=64, num_hidden_layers=1, image_token_len=4),
+                       vision_model_path='/nonexistent').eval()
+
+
+def row(image_ids, segments, filler=7):
+    ids = [1]
+    for _ in range(segments):
+        ids += image_ids + [filler]
+    return ids
+
+
+def test_image_mask_limits_segments_per_row():
+    model = build_model()
+    image_ids = model.params.image_ids
+    n = len(image_ids)
+    # 两个样本都含 2 段 image token，但第 2 个样本只有 1 张有效图像（第 2 个槽位是补齐的）
+    tokens = torch.tensor([row(image_ids, 2), row(image_ids, 2)])
+    h = model.model.embed_tokens(tokens)
+    vision = torch.randn(2, 2, 196, 768)
+    image_mask = torch.tensor([[True, True], [True, False]])
+
+    out = model.count_vision_proj(tokens, h, vision, image_mask=image_mask)
+    proj = model.vision_proj(vision)
+    first, second = slice(1, 1 + n), slice(2 + n, 2 + 2 * n)
+    assert torch.allclose(out[0, first], proj[0, 0], atol=1e-5)
+    assert torch.allclose(out[0, second], proj[0, 1], atol=1e-5)
+    assert torch.allclose(out[1, first], proj[1, 0], atol=1e-5)
+    # 补齐槽位不得写入，对应段保持原 token embedding
+    assert torch.equal(out[1, second], h[1, second])
+
+
+def test_without_mask_uses_all_slots():
+    model = build_model()
+    image_ids = model.params.image_ids
+    n = len(image_ids)
+    tokens = torch.tensor([row(image_ids, 2)])
+    h = model.model.embed_tokens(tokens)
+    vision = torch.randn(1, 2, 196, 768)
+    out = model.count_vision_proj(tokens, h, vision)
+    assert torch.allclose(out[0, 2 + n:2 + 2 * n], model.vision_proj(vision)[0, 1], atol=1e-5)
+
+
+def test_forward_vision_features_respects_image_mask():
+    # 预提取特征路径（--vision_features）与 pixel 路径一样按 image_mask 限制每个样本的有效图像数
+    model = build_model()
+    image_ids = model.params.image_ids
+    n = len(image_ids)
+    tokens = torch.tensor([row(image_ids, 2), row(image_ids, 2)])
+    features = torch.randn(2, 2, 196, 768)
+    image_mask = torch.tensor([[True, True], [True, False]])
+    with torch.no_grad():
+        masked = model(tokens, vision_features=features, image_mask=image_mask).logits
+        # 第 2 个样本的补齐槽位换成任意值，结果不应改变
+        features[1, 1] = torch.randn(196, 768)
+        refilled = model(tokens, vision_features=features, image_mask=image_mask).logits
+        unmasked = model(tokens, vision_features=features).logits
+    assert torch.equal(masked, refilled)
+    assert torch.allclose(masked[0], unmasked[0], atol=1e-5)
+    assert not torch.allclose(masked[1, 2 + n:], unmasked[1, 2 + n:])
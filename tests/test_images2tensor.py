@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+pytest.importorskip('transformers')
+from transformers import CLIPImageProcessor
+
+from model.model_vlm import MiniMindVLM
+
+
+@pytest.fixture(scope='module')
+def processor():
+    # 默认参数即 clip-vit-base-patch16 的预处理配置（shortest_edge=224, crop 224, bicubic），无需下载
+    return CLIPImageProcessor()
+
+
+def textured(size, seed=0):
+    # 低分辨率噪声放大，得到带纹理的图像，使插值 / 降采样误差能显现
+    w, h = size
+    arr = (np.random.default_rng(seed).random((max(h // 10, 1), max(w // 10, 1), 3)) * 255).astype(np.uint8)
+    return Image.fromarray(arr).resize((w, h), Image.BICUBIC)
+
+
+def saved(image, path, **kwargs):
+    image.save(path, **kwargs)
+    return Image.open(path)
+
+
+def reference(processor, path):
+    return processor(images=Image.open(path).convert('RGB'), return_tensors='pt')['pixel_values']
+
+
+@pytest.mark.parametrize('size, fmt, mode', [
+    ((1166, 1750), 'JPEG', 'RGB'),
+    ((1750, 1166), 'JPEG', 'RGB'),
+    ((300, 200), 'JPEG', 'RGB'),
+    ((224, 224), 'PNG', 'RGB'),
+    ((640, 480), 'PNG', 'RGBA'),
+    ((500, 333), 'PNG', 'L'),
+    ((180, 260), 'PNG', 'P'),
+])
+def test_matches_clip_processor(tmp_path, processor, size, fmt, mode):
+    path = tmp_path / f'img.{fmt.lower()}'
+    saved(textured(size).convert(mode), path, format=fmt)
+    out = MiniMindVLM.images2tensor([Image.open(path)], processor)
+    ref = reference(processor, path)
+    assert out.shape == ref.shape == (1, 3, 224, 224)
+    assert (out - ref).abs().max().item() < 1e-5
+
+
+def test_batch_matches_single(tmp_path, processor):
+    paths = []
+    for i, size in enumerate([(1166, 1750), (320, 240), (224, 400)]):
+        paths.append(tmp_path / f'{i}.jpg')
+        saved(textured(size, seed=i), paths[-1], quality=90)
+    batch = MiniMindVLM.images2tensor([Image.open(p) for p in paths], processor)
+    single = torch.cat([MiniMindVLM.images2tensor([Image.open(p)], processor) for p in paths])
+    assert torch.equal(batch, single)
+
+
+def test_draft_decode_is_opt_in_and_bounded(tmp_path, processor):
+    # draft 解码只用于推理：默认必须与全分辨率解码一致；开启后误差有界但不为零
+    path = tmp_path / 'big.jpg'
+    saved(textured((1166, 1750)), path, quality=90)
+    ref = reference(processor, path)
+    default = MiniMindVLM.images2tensor([Image.open(path)], processor)
+    draft = MiniMindVLM.images2tensor([Image.open(path)], processor, draft=True)
+    assert (default - ref).abs().max().item() < 1e-5
+    err = (draft - ref).abs().max().item()
+    assert 0 < err < 0.25
+    assert (draft - ref).abs().mean().item() < 0.02
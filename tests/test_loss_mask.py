@@ -0,0 +1,92 @@
+import random
+
+import pytest
+import torch
+
+from dataset.lm_dataset import generate_loss_mask_batch
+
+
+def reference_loss_mask(input_ids, bos_id, eos_id, max_length):
+    # 向量化之前 VLMDataset._generate_loss_mask 的逐 token 实现，作为对照
+    loss_mask = [0] * len(input_ids)
+    i = 0
+    while i < len(input_ids):
+        if input_ids[i:i + len(bos_id)] == bos_id:
+            start = i + len(bos_id)
+            end = start
+            while end < len(input_ids):
+                if input_ids[end:end + len(eos_id)] == eos_id:
+                    break
+                end += 1
+            for j in range(start + 1, min(end + len(eos_id) + 1, max_length)):
+                loss_mask[j] = 1
+            i = end + len(eos_id) if end < len(input_ids) else len(input_ids)
+        else:
+            i += 1
+    return loss_mask
+
+
+def random_row(rng, seq_len, bos_id, eos_id, vocab=6):
+    # 小词表随机 token，并随机插入完整的 bos/eos，使部分匹配、重叠和缺失 eos 都会出现
+    row = [rng.randrange(vocab) for _ in range(seq_len)]
+    for _ in range(rng.randrange(4)):
+        marker = bos_id if rng.random() < 0.5 else eos_id
+        pos = rng.randrange(max(seq_len - len(marker) + 1, 1))
+        row[pos:pos + len(marker)] = marker
+    return row[:seq_len]
+
+
+def check(rows, bos_id, eos_id, max_length):
+    got = generate_loss_mask_batch(torch.tensor(rows, dtype=torch.long), bos_id, eos_id, max_length)
+    want = [reference_loss_mask(row, bos_id, eos_id, max_length) for row in rows]
+    assert got.tolist() == want
+
+
+@pytest.mark.parametrize('bos_id, eos_id', [
+    ([1], [2]),
+    ([1, 3], [2]),
+    ([1], [2, 4]),
+    ([1, 3, 5], [2, 4]),
+    ([1, 2], [2, 1]),
+])
+def test_fuzz_against_reference(bos_id, eos_id):
+    rng = random.Random(0)
+    for _ in range(300):
+        seq_len = rng.randrange(1, 40)
+        max_length = rng.choice([seq_len, rng.randrange(1, seq_len + 1)])
+        rows = [random_row(rng, seq_len, bos_id, eos_id) for _ in range(rng.randrange(1, 6))]
+        check(rows, bos_id, eos_id, max_length)
+
+
+def test_missing_eos_masks_to_end():
+    row = [0, 1, 3, 7, 7, 7, 7]
+    check([row], [1, 3], [2, 4], max_length=len(row))
+    assert generate_loss_mask_batch(torch.tensor([row]), [1, 3], [2, 4], len(row)).tolist() == [[0, 0, 0, 0, 1, 1, 1]]
+
+
+def test_truncated_at_max_length():
+    row = [1, 3, 5, 5, 5, 5, 2, 4, 0, 0]
+    for max_length in range(1, len(row) + 1):
+        check([row], [1, 3], [2, 4], max_length)
+
+
+def test_max_length_beyond_row_is_clamped():
+    # padding=False 的样本短于 max_length；旧循环在此越界，批量版应等价于 max_length == L
+    rng = random.Random(1)
+    for _ in range(100):
+        seq_len = rng.randrange(1, 30)
+        rows = [random_row(rng, seq_len, [1, 3], [2]) for _ in range(3)]
+        long = generate_loss_mask_batch(torch.tensor(rows), [1, 3], [2], seq_len + rng.randrange(1, 10))
+        assert long.tolist() == generate_loss_mask_batch(torch.tensor(rows), [1, 3], [2], seq_len).tolist()
+
+
+def test_batch_rows_are_independent():
+    rows = [
+        [1, 5, 5, 2, 0, 1, 5, 2, 0, 0],
+        [0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+        [1, 5, 5, 5, 5, 5, 5, 5, 5, 5],
+        [2, 1, 2, 1, 2, 1, 2, 1, 2, 1],
+    ]
+    check(rows, [1], [2], max_length=8)
+    for row in rows:
+        check([row], [1], [2], max_length=8)
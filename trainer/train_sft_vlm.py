@@ -7,16 +7,17 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import argparse
 import time
 import warnings
+from functools import partial
 import torch
 import torch.distributed as dist
 from contextlib import nullcontext
 from torch import optim, nn
 from torch.nn.parallel import DistributedDataParallel
-from torch.utils.data import DataLoader, DistributedSampler
+from torch.utils.data import DataLoader, DistributedSampler, RandomSampler
 from transformers import AutoTokenizer
 from model.model_vlm import MiniMindVLM, VLMConfig
-from dataset.lm_dataset import VLMDataset
-from trainer.trainer_utils import get_lr, Logger, is_main_process, init_distributed_mode, setup_seed, init_vlm_model, vlm_checkpoint, SkipBatchSampler
+from dataset.lm_dataset import VLMDataset, PackedVLMDataset, vlm_collate_fn, vlm_pack_collate_fn
+from trainer.trainer_utils import get_lr, Logger, is_main_process, init_distributed_mode, setup_seed, init_vlm_model, vlm_checkpoint, SkipBatchSampler, LengthBucketBatchSampler
 
 warnings.filterwarnings('ignore')
 
@@ -24,23 +25,37 @@ warnings.filterwarnings('ignore')
 def train_epoch(epoch, loader, iters, start_step=0, wandb=None):
     loss_fct = nn.CrossEntropyLoss(reduction='none')
     start_time = time.time()
-    for step, (X, Y, loss_mask, pixel_values) in enumerate(loader, start=start_step + 1):
+    log_time, log_tokens = start_time, 0
+    for step, (X, Y, loss_mask, pixel_values, image_mask, image_pos, *packed) in enumerate(loader, start=start_step + 1):
         X = X.to(args.device)
         Y = Y.to(args.device)
         loss_mask = loss_mask.to(args.device)
         pixel_values = pixel_values.to(args.device)
+        image_mask = image_mask.to(args.device)
+        image_pos = image_pos.to(args.device)
+        position_ids = packed[0].to(args.device) if packed else None
+        log_tokens += (X != tokenizer.pad_token_id).sum()
         lr = get_lr(epoch * iters + step, args.epochs * iters, args.learning_rate)
         for param_group in optimizer.param_groups:
             param_group['lr'] = lr
 
         with autocast_ctx:
-            res = model(X, pixel_values=pixel_values)
-            loss = loss_fct(
-                res.logits.view(-1, res.logits.size(-1)),
-                Y.view(-1)
-            ).view(Y.size())
-
-            loss = (loss * loss_mask).sum() / loss_mask.sum()
+            # chunked_loss：模型只在 loss_mask 位置分块过 lm_head 算 loss，不生成完整 logits
+            loss_kwargs = {'labels': Y, 'loss_mask': loss_mask} if args.chunked_loss else {}
+            if args.vision_features:
+                res = model(X, vision_features=pixel_values, image_mask=image_mask, image_pos=image_pos,
+                            position_ids=position_ids, **loss_kwargs)
+            else:
+                res = model(X, pixel_values=pixel_values, image_mask=image_mask, image_pos=image_pos,
+                            position_ids=position_ids, **loss_kwargs)
+            if args.chunked_loss:
+                loss = res.loss
+            else:
+                loss = loss_fct(
+                    res.logits.view(-1, res.logits.size(-1)),
+                    Y.view(-1)
+                ).view(Y.size())
+                loss = (loss * loss_mask).sum() / loss_mask.sum()
             loss += res.aux_loss
             loss = loss / args.accumulation_steps
 
@@ -60,10 +75,13 @@ def train_epoch(epoch, loader, iters, start_step=0, wandb=None):
             current_loss = loss.item() * args.accumulation_steps
             current_lr = optimizer.param_groups[-1]['lr']
             eta_min = spend_time / (step + 1) * iters // 60 - spend_time // 60
+            # 有效 token 吞吐（不计 pad），打包与否可直接比较
+            tokens_per_sec = int(log_tokens) / max(time.time() - log_time, 1e-6)
+            log_time, log_tokens = time.time(), 0
             
-            Logger(f'Epoch:[{epoch+1}/{args.epochs}]({step}/{iters}) loss:{current_loss:.6f} lr:{current_lr:.12f} epoch_Time:{eta_min}min:')
+            Logger(f'Epoch:[{epoch+1}/{args.epochs}]({step}/{iters}) loss:{current_loss:.6f} lr:{current_lr:.12f} tokens/s:{tokens_per_sec:.0f} epoch_Time:{eta_min}min:')
             
-            if wandb: wandb.log({"loss": current_loss, "lr": current_lr, "epoch_Time": eta_min})
+            if wandb: wandb.log({"loss": current_loss, "lr": current_lr, "tokens_per_sec": tokens_per_sec, "epoch_Time": eta_min})
 
         if (step % args.save_interval == 0 or step == iters - 1) and is_main_process():
             model.eval()
@@ -101,8 +119,17 @@ if __name__ == "__main__":
     parser.add_argument('--num_hidden_layers', default=8, type=int, help="隐藏层数量")
     parser.add_argument('--max_seq_len', default=1536, type=int, help="训练的最大截断长度")
     parser.add_argument('--use_moe', default=0, type=int, choices=[0, 1], help="是否使用MoE架构（0=否，1=是）")
+    parser.add_argument('--image_tokens', default=196, type=int, help="每张图的视觉token数（196=不压缩，49/16等需与训练时一致）")
+    parser.add_argument('--vision_compress', default='pool', type=str, choices=['pool', 'resampler'], help="视觉token压缩方式（image_tokens<196时生效）")
     parser.add_argument("--data_path", type=str, default="../dataset/sft_data.jsonl", help="训练数据路径")
     parser.add_argument("--images_path", type=str, default="../dataset/sft_images", help="训练图像路径")
+    parser.add_argument("--packed_path", type=str, default="", help="scripts/pack_vlm_data.py 输出前缀，非空时直接读取预分词 memmap 数据")
+    parser.add_argument("--lazy_load", default=0, type=int, choices=[0, 1], help="是否按字节偏移索引懒加载jsonl（0=否，1=是，worker内存不随数据量增长）")
+    parser.add_argument("--vision_features", type=str, default="", help="scripts/extract_vision_features.py 输出前缀，非空时读取预提取的CLIP特征代替图像")
+    parser.add_argument("--image_shards", type=str, default="", help="scripts/pack_image_shards.py 输出前缀，非空时从预处理图像分片读取（跳过JPEG解码）")
+    parser.add_argument("--bucket", default=0, type=int, choices=[0, 1], help="是否按长度分桶组batch（0=否，1=是，每个batch只补齐到batch内最长样本）")
+    parser.add_argument("--packing", default=0, type=int, choices=[0, 1], help="是否把多个样本拼接到同一行训练（0=否，1=是，文档内因果掩码，batch_size 仍按样本数计）")
+    parser.add_argument("--chunked_loss", default=1, type=int, choices=[0, 1], help="是否只在loss_mask位置分块计算lm_head+交叉熵（0=否，1=是，loss相同，省去完整logits显存）")
     parser.add_argument('--from_weight', default='pretrain_vlm', type=str, help="基于哪个权重训练，为none则不基于任何权重训练")
     parser.add_argument('--from_resume', default=0, type=int, choices=[0, 1], help="是否自动检测&续训（0=否，1=是）")
     parser.add_argument("--use_wandb", action="store_true", help="是否使用wandb")
@@ -117,7 +144,8 @@ if __name__ == "__main__":
     # ========== 2. 配置目录、模型参数、检查ckp ==========
     os.makedirs(args.save_dir, exist_ok=True)
     vlm_config = VLMConfig(hidden_size=args.hidden_size, num_hidden_layers=args.num_hidden_layers, 
-                           max_seq_len=args.max_seq_len, use_moe=bool(args.use_moe))
+                           max_seq_len=args.max_seq_len, use_moe=bool(args.use_moe),
+                           image_token_len=args.image_tokens, vision_compress=args.vision_compress)
     ckp_data = vlm_checkpoint(vlm_config, weight=args.save_weight, save_dir='../checkpoints') if args.from_resume==1 else None
     
     # ========== 3. 设置混合精度 ==========
@@ -137,10 +165,25 @@ if __name__ == "__main__":
     # ========== 5. 定义模型、数据、优化器 ==========
     model, tokenizer, preprocess = init_vlm_model(vlm_config, from_weight=args.from_weight, 
                                                    device=args.device)
-    train_ds = VLMDataset(args.data_path, args.images_path, tokenizer, preprocess=preprocess,
-                          image_special_token=vlm_config.image_special_token,
-                          max_length=vlm_config.max_seq_len)
+    if args.packed_path:
+        train_ds = PackedVLMDataset(args.packed_path, args.images_path, preprocess=preprocess,
+                                    vision_features=args.vision_features or None, image_shards=args.image_shards or None,
+                                    padding=not (args.packing or args.bucket))
+        assert train_ds.max_length == vlm_config.max_seq_len, f'packed max_length={train_ds.max_length} 与 max_seq_len 不一致'
+        assert len(train_ds.image_ids) == vlm_config.image_token_len, f'packed 图像token数={len(train_ds.image_ids)} 与 image_tokens 不一致'
+    else:
+        train_ds = VLMDataset(args.data_path, args.images_path, tokenizer, preprocess=preprocess,
+                              image_special_token=vlm_config.image_special_token,
+                              max_length=vlm_config.max_seq_len, lazy_load=bool(args.lazy_load),
+                              vision_features=args.vision_features or None, image_shards=args.image_shards or None,
+                              padding=not (args.packing or args.bucket))
     train_sampler = DistributedSampler(train_ds) if dist.is_initialized() else None
+    if args.packing:
+        collate_fn = partial(vlm_pack_collate_fn, max_length=vlm_config.max_seq_len, pad_token_id=tokenizer.pad_token_id,
+                             image_token_len=vlm_config.image_token_len)
+    else:
+        collate_fn = partial(vlm_collate_fn, pad_token_id=tokenizer.pad_token_id)
+    lengths = train_ds.sample_lengths() if args.bucket else None
     scaler = torch.cuda.amp.GradScaler(enabled=(args.dtype == 'float16'))
     optimizer = optim.AdamW(model.parameters(), lr=args.learning_rate)
     
@@ -155,17 +198,24 @@ if __name__ == "__main__":
     
     # ========== 7. DDP包模型 ==========
     if dist.is_initialized():
-        model._ddp_params_and_buffers_to_ignore = {"pos_cis"}
+        model._ddp_params_and_buffers_to_ignore = {"model.freqs_cos", "model.freqs_sin"}
         model = DistributedDataParallel(model, device_ids=[local_rank])
     
     # ========== 8. 开始训练 ==========
     for epoch in range(start_epoch, args.epochs):
         train_sampler and train_sampler.set_epoch(epoch)
-        if epoch == start_epoch and start_step > 0: # 第一个epoch且存在检查点
+        if args.bucket: # 按长度分桶，续训时同样跳过前start_step个step
+            skip = start_step + 1 if epoch == start_epoch and start_step > 0 else 0
+            base_sampler = train_sampler or RandomSampler(train_ds, generator=torch.Generator().manual_seed(42 + epoch))
+            batch_sampler = LengthBucketBatchSampler(base_sampler, lengths, args.batch_size, skip, seed=epoch)
+            loader = DataLoader(train_ds, batch_sampler=batch_sampler, num_workers=args.num_workers, pin_memory=True, collate_fn=collate_fn)
+            if skip: Logger(f'Epoch [{epoch + 1}/{args.epochs}]: 跳过前{start_step}个step，从step {start_step + 1}开始')
+            train_epoch(epoch, loader, len(loader) + skip, start_step if skip else 0, wandb)
+        elif epoch == start_epoch and start_step > 0: # 第一个epoch且存在检查点
             batch_sampler = SkipBatchSampler(train_sampler or range(len(train_ds)), args.batch_size, start_step + 1)
-            loader = DataLoader(train_ds, batch_sampler=batch_sampler, num_workers=args.num_workers, pin_memory=True)
+            loader = DataLoader(train_ds, batch_sampler=batch_sampler, num_workers=args.num_workers, pin_memory=True, collate_fn=collate_fn)
             Logger(f'Epoch [{epoch + 1}/{args.epochs}]: 跳过前{start_step}个step，从step {start_step + 1}开始')
             train_epoch(epoch, loader, len(loader) + start_step + 1, start_step, wandb)
         else: # 默认从头开始
-            loader = DataLoader(train_ds, batch_size=args.batch_size, shuffle=(train_sampler is None), sampler=train_sampler, num_workers=args.num_workers, pin_memory=True)
+            loader = DataLoader(train_ds, batch_size=args.batch_size, shuffle=(train_sampler is None), sampler=train_sampler, num_workers=args.num_workers, pin_memory=True, collate_fn=collate_fn)
             train_epoch(epoch, loader, len(loader), 0, wandb)
@@ -156,3 +156,33 @@ class SkipBatchSampler(Sampler):
         total_batches = (len(self.sampler) + self.batch_size - 1) // self.batch_size
         return max(0, total_batches - self.skip_batches)
 
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    按长度分桶组 batch：sampler 给出的索引每 bucket_batches 个 batch 为一组，组内按 token 长度排序后切 batch，
+    再把整个 epoch 的 batch 顺序打乱（seed 相同则顺序相同），配合 collate 只补齐到 batch 内最长样本。
+    sampler 可以是 DistributedSampler（DDP 分片，set_epoch 洗牌）或按 epoch 固定种子的 RandomSampler；
+    skip_batches 与 SkipBatchSampler 一致，用于断点续训跳过已训练的 batch。
+    """
+
+    def __init__(self, sampler, lengths, batch_size, skip_batches=0, bucket_batches=100, seed=0):
+        self.sampler = sampler
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.skip_batches = skip_batches
+        self.bucket_batches = bucket_batches
+        self.seed = seed
+
+    def __iter__(self):
+        indices = list(self.sampler)
+        bucket = self.batch_size * self.bucket_batches
+        batches = []
+        for start in range(0, len(indices), bucket):
+            chunk = sorted(indices[start:start + bucket], key=lambda i: self.lengths[i])
+            batches.extend(chunk[i:i + self.batch_size] for i in range(0, len(chunk), self.batch_size))
+        random.Random(self.seed).shuffle(batches)
+        yield from batches[self.skip_batches:]
+
+    def __len__(self):
+        total_batches = (len(self.sampler) + self.batch_size - 1) // self.batch_size
+        return max(0, total_batches - self.skip_batches)
@@ -5,6 +5,8 @@ from datetime import datetime
 
 import pandas as pd
 
+from utils.manifest import code_version, file_signature, line_hash, load_manifest, save_manifest
+
 
 def _safe_str(x):
     if x is None:
@@ -24,6 +26,161 @@ def _article_id_to_image_relpath(article_id: str) -> str:
     return os.path.join("images", prefix, f"{s}.jpg")
 
 
+def _make_item(article_id, image_rel, title, desc, raw):
+    return {
+        "item_id": article_id,
+        "image_path": image_rel,
+        "title": title,
+        "desc": desc,
+        "raw": raw,
+        "attrs": {
+            "category": None,
+            "color": None,
+            "style": None,
+            "season": None,
+            "material": None,
+            "pattern": None,
+            "gender": None,
+            "fit": None,
+            "sleeve_length": None,
+            "neckline": None,
+        },
+    }
+
+
+def _write_items_rowwise(f, df: pd.DataFrame, raw_dir: str, required_cols, item_hashes: dict):
+    out_count = 0
+    missing_img = 0
+
+    for i in range(len(df)):
+        row = df.iloc[i]
+        article_id = _safe_str(row["article_id"])
+        if not article_id:
+            continue
+
+        image_rel = _article_id_to_image_relpath(article_id)
+        image_abs = os.path.join(raw_dir, image_rel)
+        if not os.path.isfile(image_abs):
+            missing_img += 1
+            continue
+
+        # build a pseudo-title from taxonomy fields
+        title_parts = [
+            _safe_str(row.get("product_type_name")),
+            _safe_str(row.get("product_group_name")),
+            _safe_str(row.get("index_group_name")),
+            _safe_str(row.get("section_name")),
+        ]
+        title = " | ".join([p for p in title_parts if p]) if any(title_parts) else None
+
+        desc = _safe_str(row.get("detail_desc"))
+
+        raw = {c: _safe_str(row.get(c)) for c in required_cols if c != "article_id"}
+
+        item = _make_item(article_id, image_rel.replace("\\", "/"), title, desc, raw)
+        line = json.dumps(item, ensure_ascii=False) + "\n"
+        f.write(line)
+        item_hashes[article_id] = line_hash(line)
+        out_count += 1
+
+    return out_count, missing_img
+
+
+def _scan_image_files(images_dir: str) -> set:
+    # One pass over images/0xx/ instead of an isfile() call per article.
+    # Returns "0xx/0xxxxxxxxx.jpg" keys.
+    found = set()
+    with os.scandir(images_dir) as it:
+        for sub in it:
+            if not sub.is_dir():
+                continue
+            with os.scandir(sub.path) as files:
+                for e in files:
+                    if e.is_file():
+                        found.add(f"{sub.name}/{e.name}")
+    return found
+
+
+def _safe_str_column(col: pd.Series) -> pd.Series:
+    # Column version of _safe_str: stripped str, or None for NaN/empty.
+    notna = col.notna()
+    s = pd.Series([None] * len(col), index=col.index, dtype=object)
+    s[notna] = col[notna].astype(str).str.strip()
+    s[s == ""] = None
+    return s
+
+
+def _join_title_column(parts) -> pd.Series:
+    # " | ".join of the non-None parts, None when all parts are None.
+    title = pd.Series([None] * len(parts[0]), index=parts[0].index, dtype=object)
+    for p in parts:
+        has_p = p.notna()
+        has_t = title.notna()
+        both = has_p & has_t
+        title[both] = title[both] + " | " + p[both]
+        only_p = has_p & ~has_t
+        title[only_p] = p[only_p]
+    return title
+
+
+def _write_items_columnar(
+    f, df: pd.DataFrame, images_dir: str, required_cols, chunk_size: int, item_hashes: dict
+):
+    existing = _scan_image_files(images_dir)
+    raw_cols = [c for c in required_cols if c != "article_id"]
+
+    out_count = 0
+    missing_img = 0
+    chunk_size = max(1, chunk_size)
+
+    for start in range(0, len(df), chunk_size):
+        chunk = df.iloc[start:start + chunk_size]
+
+        article_id = _safe_str_column(chunk["article_id"])
+        chunk = chunk[article_id.notna()]
+        article_id = article_id[article_id.notna()]
+        if chunk.empty:
+            continue
+
+        padded = article_id.str.zfill(10)
+        image_key = padded.str[:3] + "/" + padded + ".jpg"
+        has_img = image_key.isin(existing).to_numpy()
+        missing_img += int((~has_img).sum())
+
+        chunk = chunk[has_img]
+        article_id = article_id[has_img]
+        image_rel = "images/" + image_key[has_img]
+
+        cleaned = {c: _safe_str_column(chunk[c]) for c in raw_cols}
+        title = _join_title_column([
+            cleaned["product_type_name"],
+            cleaned["product_group_name"],
+            cleaned["index_group_name"],
+            cleaned["section_name"],
+        ])
+
+        article_ids = article_id.tolist()
+        raw_rows = zip(*[cleaned[c].tolist() for c in raw_cols])
+        lines = [
+            json.dumps(
+                _make_item(aid, rel, t, d, dict(zip(raw_cols, raw_row))),
+                ensure_ascii=False,
+            ) + "\n"
+            for aid, rel, t, d, raw_row in zip(
+                article_ids,
+                image_rel.tolist(),
+                title.tolist(),
+                cleaned["detail_desc"].tolist(),
+                raw_rows,
+            )
+        ]
+        f.writelines(lines)
+        item_hashes.update(zip(article_ids, map(line_hash, lines)))
+        out_count += len(lines)
+
+    return out_count, missing_img
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -42,6 +199,18 @@ def main():
         default=0,
         help="Limit number of items for quick runs (0 means no limit)",
     )
+    parser.add_argument(
+        "--mode",
+        choices=["columnar", "row"],
+        default="columnar",
+        help="columnar: vectorized column ops + one image dir scan; row: per-row reference path",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=20000,
+        help="Rows per serialized chunk in columnar mode",
+    )
     args = parser.parse_args()
 
     raw_dir = args.raw_dir
@@ -80,57 +249,30 @@ def main():
     total = len(df)
     n = total if args.max_items <= 0 else min(total, args.max_items)
 
-    out_count = 0
-    missing_img = 0
+    # Full rebuild by design: the manifest only feeds the change summary below.
+    # Both modes write identical output, so the mode is not part of the version.
+    version = code_version([os.path.abspath(__file__)])
+    prev_hashes = load_manifest(args.out_file, version)
+    item_hashes = {}
 
     with open(args.out_file, "w", encoding="utf-8") as f:
-        for i in range(n):
-            row = df.iloc[i]
-            article_id = _safe_str(row["article_id"])
-            if not article_id:
-                continue
+        if args.mode == "columnar":
+            out_count, missing_img = _write_items_columnar(
+                f, df.iloc[:n], images_dir, required_cols, args.chunk_size, item_hashes
+            )
+        else:
+            out_count, missing_img = _write_items_rowwise(
+                f, df.iloc[:n], raw_dir, required_cols, item_hashes
+            )
 
-            image_rel = _article_id_to_image_relpath(article_id)
-            image_abs = os.path.join(raw_dir, image_rel)
-            if not os.path.isfile(image_abs):
-                missing_img += 1
-                continue
-
-            # build a pseudo-title from taxonomy fields
-            title_parts = [
-                _safe_str(row.get("product_type_name")),
-                _safe_str(row.get("product_group_name")),
-                _safe_str(row.get("index_group_name")),
-                _safe_str(row.get("section_name")),
-            ]
-            title = " | ".join([p for p in title_parts if p]) if any(title_parts) else None
-
-            desc = _safe_str(row.get("detail_desc"))
-
-            raw = {c: _safe_str(row.get(c)) for c in required_cols if c != "article_id"}
-
-            item = {
-                "item_id": article_id,
-                "image_path": image_rel.replace("\\", "/"),
-                "title": title,
-                "desc": desc,
-                "raw": raw,
-                "attrs": {
-                    "category": None,
-                    "color": None,
-                    "style": None,
-                    "season": None,
-                    "material": None,
-                    "pattern": None,
-                    "gender": None,
-                    "fit": None,
-                    "sleeve_length": None,
-                    "neckline": None,
-                },
-            }
-
-            f.write(json.dumps(item, ensure_ascii=False) + "\n")
-            out_count += 1
+    save_manifest(
+        args.out_file,
+        stage="00_prepare_kaggle_data",
+        version=version,
+        inputs={"articles_csv": file_signature(articles_csv)},
+        items=item_hashes,
+    )
+    unchanged = sum(1 for k, h in item_hashes.items() if prev_hashes.get(k) == h)
 
     summary = {
         "time": datetime.now().isoformat(timespec="seconds"),
@@ -139,6 +281,9 @@ def main():
         "processed_rows": n,
         "written_items": out_count,
         "missing_images_skipped": missing_img,
+        "unchanged_items": unchanged,
+        "new_or_changed_items": len(item_hashes) - unchanged,
+        "removed_items": sum(1 for k in prev_hashes if k not in item_hashes),
         "out_file": args.out_file,
     }
 
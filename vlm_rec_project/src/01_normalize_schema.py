@@ -1,11 +1,23 @@
 import argparse
 import json
 import os
+import stat
 from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import pandas as pd
 from PIL import Image
 
+from utils.manifest import (
+    PreviousOutput,
+    code_version,
+    file_signature,
+    line_hash,
+    load_manifest,
+    save_manifest,
+)
+
 
 ALLOWED_COLORS_12 = {
     "black",
@@ -103,6 +115,45 @@ def _map_gender(index_group_name: str) -> str:
     return "unknown"
 
 
+def _map_pattern(graphical_appearance_name: str) -> str:
+    if not graphical_appearance_name:
+        return "unknown"
+    return _norm_lower(graphical_appearance_name)
+
+
+def _map_column(values, fn) -> np.ndarray:
+    # Evaluate fn once per distinct value, then gather by factorized codes.
+    # NaN/None get code -1, which picks the trailing fn(None) entry.
+    codes, uniques = pd.factorize(pd.Series(values, dtype=object))
+    table = np.array([fn(u) for u in uniques] + [fn(None)], dtype=object)
+    return table[codes]
+
+
+def _raw_column(raws, key: str) -> np.ndarray:
+    return _map_column([r.get(key) for r in raws], _safe_str)
+
+
+def _coalesce(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # column version of `a or b` for str-or-None values
+    return np.where(pd.isna(a) | (a == ""), b, a)
+
+
+def _normalize_attr_columns(raws) -> dict:
+    """Map raw H&M columns to normalized attrs with per-distinct-value lookup tables."""
+    color_src = _coalesce(
+        _raw_column(raws, "perceived_colour_master_name"),
+        _raw_column(raws, "colour_group_name"),
+    )
+    style_src = _coalesce(_raw_column(raws, "index_name"), _raw_column(raws, "section_name"))
+    return {
+        "category": _map_column(_raw_column(raws, "product_type_name"), _map_category),
+        "color": _map_column(color_src, _map_hm_color_to_12),
+        "style": _map_column(style_src, lambda v: _map_style(v, None)),
+        "pattern": _map_column(_raw_column(raws, "graphical_appearance_name"), _map_pattern),
+        "gender": _map_column(_raw_column(raws, "index_group_name"), _map_gender),
+    }
+
+
 def _image_readable(path: str) -> bool:
     try:
         with Image.open(path) as img:
@@ -112,6 +163,65 @@ def _image_readable(path: str) -> bool:
         return False
 
 
+def _load_verify_cache(path: str) -> dict:
+    # {abs_path: [size, mtime_ns, readable]}
+    if not path or not os.path.isfile(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _save_verify_cache(path: str, cache: dict):
+    if not path:
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(cache, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def _verify_images(paths, cache: dict, num_workers: int):
+    """Return (readable flags in input order, cache hits, fresh checks).
+
+    Only images whose (path, size, mtime) is not in the cache are opened;
+    those are verified in a process pool and written back into ``cache``.
+    """
+    results = [False] * len(paths)
+    todo = []
+    hits = 0
+    for i, path in enumerate(paths):
+        if not path:
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if not stat.S_ISREG(st.st_mode):
+            continue
+        key = os.path.abspath(path)
+        entry = cache.get(key)
+        if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            results[i] = bool(entry[2])
+            hits += 1
+        else:
+            todo.append((i, key, st.st_size, st.st_mtime_ns))
+
+    todo_paths = [t[1] for t in todo]
+    if num_workers > 1 and len(todo_paths) > 1:
+        chunksize = max(1, min(256, len(todo_paths) // (num_workers * 4)))
+        with ProcessPoolExecutor(max_workers=num_workers) as ex:
+            oks = list(ex.map(_image_readable, todo_paths, chunksize=chunksize))
+    else:
+        oks = [_image_readable(p) for p in todo_paths]
+
+    for (i, key, size, mtime_ns), ok in zip(todo, oks):
+        results[i] = ok
+        cache[key] = [size, mtime_ns, ok]
+
+    return results, hits, len(todo)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -137,6 +247,25 @@ def main():
         default=0,
         help="Limit number of items for quick profiling (0 means no limit)",
     )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Processes used for image verification (1 = serial)",
+    )
+    parser.add_argument(
+        "--verify_cache",
+        default=os.path.join("vlm_rec_project", "data", "cache", "image_verify.json"),
+        help="Persistent image verification cache keyed by (path, size, mtime); empty string disables it",
+    )
+    parser.add_argument(
+        "--incremental",
+        type=int,
+        default=1,
+        choices=[0, 1],
+        help="Copy previous output lines for items whose input line is unchanged, without re-normalizing "
+        "them; their images are re-verified only when the image stat changed (0 = full rewrite)",
+    )
     args = parser.parse_args()
 
     if not os.path.isfile(args.items_file):
@@ -155,76 +284,112 @@ def main():
 
     n_limit = args.max_items if args.max_items and args.max_items > 0 else None
 
-    with open(args.items_file, "r", encoding="utf-8") as fin, open(
-        args.out_items_file, "w", encoding="utf-8"
-    ) as fout:
+    # Manifest entries: input line hash -> [output line hash, image_path, image [size, mtime_ns],
+    # image readable, attrs]. Unchanged input lines are copied through from the previous output
+    # without being parsed or normalized; only their image is stat'ed, and re-verified when the
+    # stat differs from the entry. Their report stats come from the manifest entry.
+    version = code_version([os.path.abspath(__file__)])
+    prev_items = load_manifest(args.out_items_file, version) if args.incremental else {}
+    previous = PreviousOutput([args.out_items_file]) if prev_items else None
+
+    rows = []  # (in_hash, previous output line or None, manifest entry or None), in input order
+    items = []  # parsed items for rows without a reusable previous line
+    stale_paths = []  # images of copied rows whose stat changed, verified together with items
+
+    with open(args.items_file, "r", encoding="utf-8") as fin:
         for line in fin:
             if not line.strip():
                 continue
 
-            item = json.loads(line)
             total += 1
             if n_limit is not None and total > n_limit:
                 break
 
-            raw = item.get("raw") or {}
-
-            category = _map_category(_safe_str(raw.get("product_type_name")))
-            color = _map_hm_color_to_12(
-                _safe_str(raw.get("perceived_colour_master_name"))
-                or _safe_str(raw.get("colour_group_name"))
-            )
-            style = _map_style(
-                _safe_str(raw.get("index_name")),
-                _safe_str(raw.get("section_name")),
-            )
-            pattern = (
-                _norm_lower(_safe_str(raw.get("graphical_appearance_name")))
-                if _safe_str(raw.get("graphical_appearance_name"))
-                else "unknown"
-            )
-            gender = _map_gender(_safe_str(raw.get("index_group_name")))
-
-            attrs = item.get("attrs") or {}
-            attrs.update(
-                {
-                    "category": category,
-                    "color": color,
-                    "style": style,
-                    "season": "unknown",
-                    "material": "unknown",
-                    "pattern": pattern,
-                    "gender": gender,
-                    "fit": "unknown",
-                    "sleeve_length": "unknown",
-                    "neckline": "unknown",
-                }
-            )
-            item["attrs"] = attrs
-
-            # image readability
-            image_rel = item.get("image_path")
-            image_abs = (
-                os.path.join(args.raw_dir, image_rel)
-                if image_rel
-                else None
-            )
-            if image_abs and os.path.isfile(image_abs) and _image_readable(image_abs):
-                readable += 1
-
-            # stats
-            counters["category"][category] += 1
-            counters["color"][color] += 1
-            counters["style"][style] += 1
-            counters["pattern"][pattern] += 1
-            counters["gender"][gender] += 1
+            in_hash = line_hash(line)
+            entry = prev_items.get(in_hash)
+            out_line = previous.get(entry[0]) if entry is not None else None
+            if out_line is None:
+                entry = None
+                items.append(json.loads(line))
+            else:
+                image_path = os.path.join(args.raw_dir, entry[1]) if entry[1] else None
+                image_sig = file_signature(image_path) if image_path else None
+                if image_sig != entry[2]:
+                    # readability filled in after verification
+                    entry = [entry[0], entry[1], image_sig, None, entry[4]]
+                    stale_paths.append(image_path)
+            rows.append((in_hash, out_line, entry))
+
+    if previous is not None:
+        previous.close()
+
+    columns = _normalize_attr_columns([item.get("raw") or {} for item in items])
+
+    image_paths = []
+    for i, item in enumerate(items):
+        attrs = item.get("attrs") or {}
+        attrs.update(
+            {
+                "category": columns["category"][i],
+                "color": columns["color"][i],
+                "style": columns["style"][i],
+                "season": "unknown",
+                "material": "unknown",
+                "pattern": columns["pattern"][i],
+                "gender": columns["gender"][i],
+                "fit": "unknown",
+                "sleeve_length": "unknown",
+                "neckline": "unknown",
+            }
+        )
+        item["attrs"] = attrs
+
+        image_rel = item.get("image_path")
+        image_paths.append(os.path.join(args.raw_dir, image_rel) if image_rel else None)
 
+    # image readability (rebuilt items and copied items whose image stat changed)
+    verify_cache = _load_verify_cache(args.verify_cache)
+    readable_flags, cache_hits, fresh_checks = _verify_images(
+        image_paths + stale_paths, verify_cache, args.num_workers
+    )
+    _save_verify_cache(args.verify_cache, verify_cache)
+
+    new_items = {}
+    reused = 0
+    rebuilt = iter(zip(items, image_paths, readable_flags))
+    reverified = iter(readable_flags[len(items):])
+
+    tmp_out = args.out_items_file + ".tmp"
+    with open(tmp_out, "w", encoding="utf-8") as fout:
+        for in_hash, out_line, entry in rows:
+            if entry is None:
+                item, image_path, ok = next(rebuilt)
+                out_line = json.dumps(item, ensure_ascii=False) + "\n"
+                image_sig = file_signature(image_path) if image_path else None
+                entry = [line_hash(out_line), item.get("image_path"), image_sig, ok, item["attrs"]]
+            else:
+                reused += 1
+                if entry[3] is None:
+                    entry[3] = next(reverified)
+            new_items[in_hash] = entry
+            fout.write(out_line)
+
+            attrs = entry[4]
+            readable += bool(entry[3])
+            for field in ["category", "color", "style", "pattern", "gender"]:
+                counters[field][attrs.get(field)] += 1
             for k, v in attrs.items():
                 field_counts[k] += 1
                 if v == "unknown" or v is None:
                     unknown_counts[k] += 1
-
-            fout.write(json.dumps(item, ensure_ascii=False) + "\n")
+    os.replace(tmp_out, args.out_items_file)
+    save_manifest(
+        args.out_items_file,
+        stage="01_normalize_schema",
+        version=version,
+        inputs={"items_file": file_signature(args.items_file)},
+        items=new_items,
+    )
 
     img_read_rate = readable / total if total > 0 else 0.0
 
@@ -236,6 +401,9 @@ def main():
     lines.append(f"Generated from: `{args.items_file}`\n")
     lines.append(f"Total items profiled: **{total}**\n")
     lines.append(f"Image readable rate: **{img_read_rate:.4f}** ({readable}/{total})\n")
+    lines.append(
+        f"Image verification: {cache_hits} cache hits, {fresh_checks} fresh checks\n"
+    )
 
     lines.append("## Field distributions (top 20)\n")
     for field in ["category", "color", "style", "pattern", "gender"]:
@@ -274,6 +442,11 @@ def main():
                 "total": total,
                 "image_readable": readable,
                 "image_readable_rate": img_read_rate,
+                "verify_cache_hits": cache_hits,
+                "verify_fresh_checks": fresh_checks,
+                "reused_items": reused,
+                "rebuilt_items": len(items),
+                "reverified_images": len(stale_paths),
             },
             ensure_ascii=False,
             indent=2,
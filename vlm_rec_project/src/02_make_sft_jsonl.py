@@ -2,8 +2,20 @@ import argparse
 import json
 import os
 import random
-from typing import Any, Dict, List, Tuple
-
+import re
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from utils import prompts, schema
+from utils.manifest import (
+    PreviousOutput,
+    code_version,
+    file_signature,
+    line_hash,
+    load_manifest,
+    save_manifest,
+)
 from utils.prompts import build_system_prompt, build_user_prompt
 from utils.schema import (
     CONFIDENCE_FIELDS,
@@ -11,15 +23,16 @@ from utils.schema import (
     build_label_from_attrs,
     confidence_for_value,
     dumps_strict_json,
+    output_error_codes,
     validate_output,
 )
 
 
-def read_jsonl(path: str):
+def read_lines(path: str):
     with open(path, "r", encoding="utf-8") as f:
         for line in f:
             if line.strip():
-                yield json.loads(line)
+                yield line
 
 
 def ensure_dir(p: str):
@@ -61,6 +74,104 @@ def build_sft_sample(item: Dict[str, Any], raw_dir: str) -> Dict[str, Any]:
     return sample
 
 
+# Deterministic split by hash(item_id) so you can append/shuffle without changing split
+def is_eval(item_id: str, eval_ratio: float) -> bool:
+    # Use a stable hash independent of Python's random hash seed
+    h = 0
+    for ch in item_id:
+        h = (h * 131 + ord(ch)) % 1000003
+    # map to [0,1)
+    r = (h % 100000) / 100000.0
+    return r < eval_ratio
+
+
+def build_sample_line(line: str, raw_dir: str, eval_ratio: float) -> Tuple[str, Optional[str], Optional[str]]:
+    """Turn one items.normalized.jsonl line into (status, sample line, image_path).
+
+    status is "train"/"eval"/"schema_fail"/"image_missing"/"skip"; the sample
+    line is only set for train/eval.
+    """
+    item = json.loads(line)
+    item_id = str(item.get("item_id") or "")
+    if not item_id:
+        return "skip", None, None
+    image_rel = item.get("image_path")
+
+    try:
+        sample = build_sft_sample(item, raw_dir)
+        # Sanity: assistant JSON must be parseable and pass schema
+        assistant_text = sample["conversations"][2]["content"]
+        if output_error_codes(assistant_text):
+            return "schema_fail", None, image_rel
+    except FileNotFoundError:
+        return "image_missing", None, image_rel
+    except Exception:
+        return "schema_fail", None, image_rel
+
+    split = "eval" if is_eval(item_id, eval_ratio) else "train"
+    return split, json.dumps(sample, ensure_ascii=False) + "\n", image_rel
+
+
+def shard_name(split: str, shard_idx: int, num_shards: int) -> str:
+    return f"{split}-{shard_idx:05d}-of-{num_shards:05d}.jsonl"
+
+
+_SHARD_RE = re.compile(r"^(train|eval)-\d{5}-of-\d{5}\.jsonl$")
+
+
+def _write_shard(task) -> Tuple[int, Counter]:
+    shard_idx, num_shards, lines, raw_dir, eval_ratio, out_dir = task
+    stats = Counter()
+    with open(
+        os.path.join(out_dir, shard_name("train", shard_idx, num_shards)), "w", encoding="utf-8"
+    ) as f_train, open(
+        os.path.join(out_dir, shard_name("eval", shard_idx, num_shards)), "w", encoding="utf-8"
+    ) as f_eval:
+        for line in lines:
+            status, out_line, _ = build_sample_line(line, raw_dir, eval_ratio)
+            stats[status] += 1
+            if status == "train":
+                f_train.write(out_line)
+            elif status == "eval":
+                f_eval.write(out_line)
+    return shard_idx, stats
+
+
+def write_shards(lines: List[str], args) -> Counter:
+    """Parallel mode: contiguous slices of the input go to worker processes,
+    each writing train/eval shard pairs; shard sizes are listed in index.json.
+    The split is still decided per item by is_eval(item_id), so it matches the
+    single-file writer exactly.
+    """
+    num_shards = args.num_shards if args.num_shards > 0 else args.num_workers
+    for name in os.listdir(args.out_dir):
+        if _SHARD_RE.match(name):
+            os.remove(os.path.join(args.out_dir, name))
+
+    per_shard = (len(lines) + num_shards - 1) // num_shards if lines else 0
+    tasks = [
+        (i, num_shards, lines[i * per_shard:(i + 1) * per_shard], args.raw_dir, args.eval_ratio, args.out_dir)
+        for i in range(num_shards)
+    ]
+
+    totals = Counter()
+    shard_stats = {}
+    with ProcessPoolExecutor(max_workers=args.num_workers) as ex:
+        for shard_idx, stats in ex.map(_write_shard, tasks):
+            shard_stats[shard_idx] = stats
+            totals.update(stats)
+
+    index = {"num_shards": num_shards, "eval_ratio": args.eval_ratio}
+    for split in ("train", "eval"):
+        index[split] = [
+            {"file": shard_name(split, i, num_shards), "num_samples": shard_stats[i][split]}
+            for i in range(num_shards)
+        ]
+    with open(os.path.join(args.out_dir, "index.json"), "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False, indent=2)
+    return totals
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -86,6 +197,26 @@ def main():
         default=0,
         help="Limit number of items for quick runs (0 means no limit)",
     )
+    parser.add_argument(
+        "--incremental",
+        type=int,
+        default=1,
+        choices=[0, 1],
+        help="Reuse previous samples for items whose input line is unchanged (0 = full rebuild); "
+        "single-file writer only",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=1,
+        help="1 = single train.jsonl/eval.jsonl; >1 = parallel sharded writer (train-00000-of-000NN.jsonl + index.json)",
+    )
+    parser.add_argument(
+        "--num_shards",
+        type=int,
+        default=0,
+        help="Number of shards in parallel mode (0 = num_workers)",
+    )
 
     args = parser.parse_args()
 
@@ -100,54 +231,76 @@ def main():
     rnd = random.Random(args.seed)
 
     total = 0
-    written_train = 0
-    written_eval = 0
-    schema_fail = 0
-    image_missing = 0
-
-    # Deterministic split by hash(item_id) so you can append/shuffle without changing split
-    def is_eval(item_id: str) -> bool:
-        # Use a stable hash independent of Python's random hash seed
-        h = 0
-        for ch in item_id:
-            h = (h * 131 + ord(ch)) % 1000003
-        # map to [0,1)
-        r = (h % 100000) / 100000.0
-        return r < args.eval_ratio
-
-    with open(train_path, "w", encoding="utf-8") as f_train, open(
-        eval_path, "w", encoding="utf-8"
-    ) as f_eval:
-        for item in read_jsonl(args.items_file):
+    stats = Counter()
+    reused = 0
+
+    if args.num_workers > 1:
+        lines = []
+        for line in read_lines(args.items_file):
             total += 1
             if args.max_items and args.max_items > 0 and total > args.max_items:
                 break
-
-            item_id = str(item.get("item_id") or "")
-            if not item_id:
-                continue
-
-            try:
-                sample = build_sft_sample(item, args.raw_dir)
-                # Sanity: assistant JSON must be parseable and pass schema
-                assistant_text = sample["conversations"][2]["content"]
-                parsed = json.loads(assistant_text)
-                check = validate_output(parsed)
-                if not check.ok:
-                    schema_fail += 1
-                    continue
-
-                if is_eval(item_id):
-                    f_eval.write(json.dumps(sample, ensure_ascii=False) + "\n")
-                    written_eval += 1
+            lines.append(line)
+        stats = write_shards(lines, args)
+    else:
+        # Manifest entries: input line hash -> [status, output line hash, image_path].
+        version = code_version(
+            [os.path.abspath(__file__), schema.__file__, prompts.__file__],
+            eval_ratio=args.eval_ratio,
+        )
+        prev_items = load_manifest(train_path, version) if args.incremental else {}
+        previous = PreviousOutput([train_path, eval_path]) if prev_items else None
+        new_items = {}
+
+        with open(train_path + ".tmp", "w", encoding="utf-8") as f_train, open(
+            eval_path + ".tmp", "w", encoding="utf-8"
+        ) as f_eval:
+            for line in read_lines(args.items_file):
+                total += 1
+                if args.max_items and args.max_items > 0 and total > args.max_items:
+                    break
+
+                in_hash = line_hash(line)
+                entry = prev_items.get(in_hash)
+                out_line = None
+                if entry is not None and entry[0] in ("train", "eval"):
+                    if os.path.isfile(os.path.join(args.raw_dir, entry[2])):
+                        out_line = previous.get(entry[1])
+                    if out_line is None:
+                        entry = None
+                elif entry is not None and entry[0] == "image_missing":
+                    entry = None
+
+                if entry is None:
+                    status, out_line, image_rel = build_sample_line(line, args.raw_dir, args.eval_ratio)
+                    entry = [status, line_hash(out_line) if out_line else None, image_rel]
                 else:
-                    f_train.write(json.dumps(sample, ensure_ascii=False) + "\n")
-                    written_train += 1
+                    reused += 1
+                status = entry[0]
+
+                stats[status] += 1
+                new_items[in_hash] = entry
+                if status == "eval":
+                    f_eval.write(out_line)
+                elif status == "train":
+                    f_train.write(out_line)
+
+        if previous is not None:
+            previous.close()
+        os.replace(train_path + ".tmp", train_path)
+        os.replace(eval_path + ".tmp", eval_path)
+        save_manifest(
+            train_path,
+            stage="02_make_sft_jsonl",
+            version=version,
+            inputs={"items_file": file_signature(args.items_file)},
+            items=new_items,
+        )
 
-            except FileNotFoundError:
-                image_missing += 1
-            except Exception:
-                schema_fail += 1
+    written_train = stats["train"]
+    written_eval = stats["eval"]
+    schema_fail = stats["schema_fail"]
+    image_missing = stats["image_missing"]
 
     json_valid_rate = 1.0
     schema_pass_rate = (written_train + written_eval) / max(total, 1)
@@ -163,6 +316,7 @@ def main():
                 "written_eval": written_eval,
                 "image_missing": image_missing,
                 "schema_fail": schema_fail,
+                "reused_items": reused,
                 "json_valid_rate": json_valid_rate,
                 "schema_pass_rate": schema_pass_rate,
             },
@@ -0,0 +1,163 @@
+"""Compare the fp32 and dynamic-int8 CLIP vision encoders on the SFT eval split.
+
+The same MiniMindVLM checkpoint is run over data/sft/eval.jsonl with each
+vision tower in turn. The report covers patch-embedding drift, vision encoder
+latency, json/schema pass rates, field accuracy against the labels, and how
+often the two variants produce the same extraction.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import torch
+from PIL import Image
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+sys.path.append(REPO_ROOT)
+
+from transformers import AutoTokenizer  # noqa: E402
+
+from model.model_vlm import MiniMindVLM, VLMConfig  # noqa: E402
+from utils.schema import CONFIDENCE_FIELDS, validate_many  # noqa: E402
+
+VARIANTS = ("fp32", "int8")
+
+
+def load_samples(path: str, max_items: int) -> List[Dict[str, Any]]:
+    samples = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            samples.append(json.loads(line))
+            if max_items and len(samples) >= max_items:
+                break
+    return samples
+
+
+def build_prompt(tokenizer, sample: Dict[str, Any], image_token: str) -> str:
+    messages = [
+        {"role": turn["role"], "content": turn["content"].replace("<image>", image_token)}
+        for turn in sample["conversations"]
+        if turn["role"] != "assistant"
+    ]
+    return tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+
+
+def parse_output(text: str) -> Optional[Dict[str, Any]]:
+    try:
+        obj = json.loads(text)
+    except ValueError:
+        return None
+    return obj if isinstance(obj, dict) else None
+
+
+def field_accuracy(preds: List[Optional[Dict[str, Any]]], labels: List[Dict[str, Any]]) -> Dict[str, float]:
+    acc = {}
+    for k in CONFIDENCE_FIELDS:
+        hits = sum(1 for p, y in zip(preds, labels) if p is not None and p.get(k) == y.get(k))
+        acc[k] = hits / max(len(labels), 1)
+    acc["micro"] = sum(acc[k] for k in CONFIDENCE_FIELDS) / len(CONFIDENCE_FIELDS)
+    return acc
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--eval_file", default=os.path.join("vlm_rec_project", "data", "sft", "eval.jsonl"))
+    parser.add_argument(
+        "--raw_dir",
+        default=os.path.join("vlm_rec_project", "data", "raw", "hm"),
+        help="Image root the sample 'image' paths are relative to",
+    )
+    parser.add_argument("--save_dir", default="out", help="Directory with <weight>_<hidden_size>.pth")
+    parser.add_argument("--weight", default="sft_vlm")
+    parser.add_argument("--hidden_size", type=int, default=512)
+    parser.add_argument("--num_hidden_layers", type=int, default=8)
+    parser.add_argument("--use_moe", type=int, default=0, choices=[0, 1])
+    parser.add_argument("--image_tokens", type=int, default=196)
+    parser.add_argument("--vision_compress", default="pool", choices=["pool", "resampler"])
+    parser.add_argument("--tokenizer_path", default="model")
+    parser.add_argument("--vision_model_path", default=os.path.join("model", "vision_model", "clip-vit-base-patch16"))
+    parser.add_argument("--max_items", type=int, default=200, help="0 means the whole eval file")
+    parser.add_argument("--max_new_tokens", type=int, default=512)
+    parser.add_argument("--out", default=os.path.join("vlm_rec_project", "reports", "vision_int8_compare.json"))
+    args = parser.parse_args()
+
+    config = VLMConfig(
+        hidden_size=args.hidden_size,
+        num_hidden_layers=args.num_hidden_layers,
+        use_moe=bool(args.use_moe),
+        image_token_len=args.image_tokens,
+        vision_compress=args.vision_compress,
+    )
+    model = MiniMindVLM(config, vision_model_path=args.vision_model_path)
+    moe_suffix = "_moe" if args.use_moe else ""
+    ckp = os.path.join(args.save_dir, f"{args.weight}_{args.hidden_size}{moe_suffix}.pth")
+    model.load_state_dict(torch.load(ckp, map_location="cpu"), strict=False)
+    model.eval()
+    encoders = {
+        "fp32": model.vision_encoder,
+        "int8": MiniMindVLM.get_vision_model(args.vision_model_path, int8=True)[0],
+    }
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path)
+
+    samples = load_samples(args.eval_file, args.max_items)
+    labels = [json.loads(s["conversations"][-1]["content"]) for s in samples]
+    texts = {v: [] for v in VARIANTS}
+    vision_seconds = {v: 0.0 for v in VARIANTS}
+    cos_sum, max_abs = 0.0, 0.0
+
+    for i, sample in enumerate(samples):
+        images = [Image.open(os.path.join(args.raw_dir, p.strip())) for p in sample["image"].split(",")]
+        pixel_values = MiniMindVLM.images2tensor(images, model.processor).unsqueeze(0)
+        inputs = tokenizer(build_prompt(tokenizer, sample, config.image_special_token), return_tensors="pt")
+        embeddings = {}
+        for v in VARIANTS:
+            model.vision_encoder = encoders[v]
+            t0 = time.perf_counter()
+            embeddings[v] = model.encode_images(pixel_values)
+            vision_seconds[v] += time.perf_counter() - t0
+            with torch.no_grad():
+                out = model.generate(
+                    inputs.input_ids,
+                    attention_mask=inputs.attention_mask,
+                    max_new_tokens=args.max_new_tokens,
+                    do_sample=False,
+                    pad_token_id=tokenizer.pad_token_id,
+                    eos_token_id=tokenizer.eos_token_id,
+                    vision_embeds=model.vision_proj(embeddings[v]),
+                )
+            texts[v].append(tokenizer.decode(out[0, inputs.input_ids.shape[1]:], skip_special_tokens=True).strip())
+        a, b = embeddings["fp32"].flatten(0, -2), embeddings["int8"].flatten(0, -2)
+        cos_sum += torch.nn.functional.cosine_similarity(a, b, dim=-1).mean().item()
+        max_abs = max(max_abs, (a - b).abs().max().item())
+        print(f"{i + 1}/{len(samples)}", end="\r")
+    model.vision_encoder = encoders["fp32"]
+
+    n = max(len(samples), 1)
+    preds = {v: [parse_output(t) for t in texts[v]] for v in VARIANTS}
+    report = {
+        "eval_file": args.eval_file,
+        "checkpoint": ckp,
+        "num_samples": len(samples),
+        "vision_ms_per_sample": {v: 1000 * vision_seconds[v] / n for v in VARIANTS},
+        "embedding_cosine_mean": cos_sum / n,
+        "embedding_max_abs_diff": max_abs,
+        "json_valid_rate": {v: sum(p is not None for p in preds[v]) / n for v in VARIANTS},
+        "schema_pass_rate": {v: validate_many(texts[v]).pass_rate for v in VARIANTS},
+        "field_accuracy": {v: field_accuracy(preds[v], labels) for v in VARIANTS},
+        "output_exact_match": sum(a == b for a, b in zip(texts["fp32"], texts["int8"])) / n,
+        # unparseable outputs count as {} on both sides, so two failures agree
+        "field_agreement": field_accuracy([p or {} for p in preds["int8"]], [p or {} for p in preds["fp32"]]),
+    }
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
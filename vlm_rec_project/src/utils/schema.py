@@ -1,6 +1,6 @@
 import json
 from dataclasses import dataclass
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, Iterable, List, Tuple
 
 
 COLOR_12 = [
@@ -49,12 +49,30 @@ CONFIDENCE_FIELDS = [
 ]
 
 
+# Compiled lookups for the validators below.
+_SCHEMA_FIELD_SET = frozenset(SCHEMA_FIELDS)
+_CONFIDENCE_FIELD_SET = frozenset(CONFIDENCE_FIELDS)
+_COLOR_12_SET = frozenset(COLOR_12)
+_STRING_FIELDS = tuple(k for k in CONFIDENCE_FIELDS if k != "color")
+
+
 @dataclass
 class SchemaCheckResult:
     ok: bool
     errors: List[str]
 
 
+@dataclass
+class BatchCheckResult:
+    # per record: pass/fail and {field: error code}; empty dict when ok
+    ok: List[bool]
+    codes: List[Dict[str, str]]
+
+    @property
+    def pass_rate(self) -> float:
+        return sum(self.ok) / len(self.ok) if self.ok else 0.0
+
+
 def make_empty_output() -> Dict[str, Any]:
     out: Dict[str, Any] = {
         "category": "unknown",
@@ -90,7 +108,7 @@ def validate_output(obj: Any) -> SchemaCheckResult:
 
     # extra fields not allowed
     for k in obj.keys():
-        if k not in SCHEMA_FIELDS:
+        if k not in _SCHEMA_FIELD_SET:
             errors.append(f"extra field: {k}")
 
     if "confidence" in obj:
@@ -109,21 +127,19 @@ def validate_output(obj: Any) -> SchemaCheckResult:
                         if v < 0 or v > 1:
                             errors.append(f"confidence[{k}] out of range")
             for k in conf.keys():
-                if k not in CONFIDENCE_FIELDS:
+                if k not in _CONFIDENCE_FIELD_SET:
                     errors.append(f"confidence extra: {k}")
 
     # enum checks (strict only for color in Day2)
     color = obj.get("color")
     if isinstance(color, str):
-        if color not in COLOR_12:
+        if color not in _COLOR_12_SET:
             errors.append(f"invalid color enum: {color}")
     else:
         errors.append("color is not a string")
 
     # basic type checks for other string fields
-    for k in CONFIDENCE_FIELDS:
-        if k == "color":
-            continue
+    for k in _STRING_FIELDS:
         v = obj.get(k)
         if not isinstance(v, str):
             errors.append(f"{k} is not a string")
@@ -131,6 +147,72 @@ def validate_output(obj: Any) -> SchemaCheckResult:
     return SchemaCheckResult(len(errors) == 0, errors)
 
 
+def output_error_codes(obj: Any) -> Dict[str, str]:
+    """Single-pass schema check returning {field: code}; empty means valid.
+
+    Codes: "missing", "extra", "type", "enum", "range"; "$" keys the record
+    itself ("type" for a non-dict, "json" for unparseable text). Confidence
+    sub-fields are reported as "confidence.<field>". Agrees with
+    validate_output() on pass/fail but keeps one code per field.
+    """
+    if isinstance(obj, str):
+        try:
+            obj = json.loads(obj)
+        except ValueError:
+            return {"$": "json"}
+    if not isinstance(obj, dict):
+        return {"$": "type"}
+
+    codes: Dict[str, str] = {}
+    keys = obj.keys()
+    if keys != _SCHEMA_FIELD_SET:
+        for k in SCHEMA_FIELDS:
+            if k not in obj:
+                codes[k] = "missing"
+        for k in keys - _SCHEMA_FIELD_SET:
+            codes[str(k)] = "extra"
+
+    for k in _STRING_FIELDS:
+        v = obj.get(k)
+        if not isinstance(v, str) and k not in codes:
+            codes[k] = "type"
+
+    color = obj.get("color")
+    if "color" not in codes:
+        if not isinstance(color, str):
+            codes["color"] = "type"
+        elif color not in _COLOR_12_SET:
+            codes["color"] = "enum"
+
+    if "confidence" in obj:
+        conf = obj["confidence"]
+        if not isinstance(conf, dict):
+            codes["confidence"] = "type"
+        else:
+            conf_keys = conf.keys()
+            if conf_keys != _CONFIDENCE_FIELD_SET:
+                for k in CONFIDENCE_FIELDS:
+                    if k not in conf:
+                        codes["confidence." + k] = "missing"
+                for k in conf_keys - _CONFIDENCE_FIELD_SET:
+                    codes["confidence." + str(k)] = "extra"
+            for k, v in conf.items():
+                if k not in _CONFIDENCE_FIELD_SET:
+                    continue
+                if not isinstance(v, (int, float)):
+                    codes["confidence." + k] = "type"
+                elif v < 0 or v > 1:
+                    codes["confidence." + k] = "range"
+
+    return codes
+
+
+def validate_many(objs: Iterable[Any]) -> BatchCheckResult:
+    """Validate a batch of outputs (dicts or raw JSON strings) in one call."""
+    codes = [output_error_codes(o) for o in objs]
+    return BatchCheckResult([not c for c in codes], codes)
+
+
 def build_label_from_attrs(attrs: Dict[str, Any], conf_values: Dict[str, float]) -> Dict[str, Any]:
     out = make_empty_output()
     for k in CONFIDENCE_FIELDS: